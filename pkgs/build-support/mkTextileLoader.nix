@@ -11,12 +11,17 @@
   serverLaunch,
   mainClass ? "",
   libraries,
+  # A file of library lists shared between loader versions, and the one in it
+  # that goes before `libraries`
+  librarySets ? null,
+  librarySet ? null,
   extraBuildPhase ? "",
 }:
 
 let
   lib_lock = lib.importJSON ./libraries.json;
-  fetchedLibraries = lib.forEach libraries (l: "${fetchurl lib_lock.${l}}");
+  sharedLibraries = lib.optionals (librarySet != null) (lib.importJSON librarySets).${librarySet};
+  fetchedLibraries = lib.forEach (sharedLibraries ++ libraries) (l: "${fetchurl lib_lock.${l}}");
 
   classPath = lib.concatStringsSep " " fetchedLibraries;
   manifest = writeText "manifest.mf" (
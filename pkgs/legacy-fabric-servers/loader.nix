@@ -13,6 +13,7 @@ mkTextileLoader {
   launchPrefix = "fabric";
   inherit loaderVersion gameVersion;
   serverLaunch = "net.fabricmc.loader.impl.launch.server.FabricServerLauncher";
-  inherit (loader_lock) mainClass;
+  inherit (loader_lock) mainClass librarySet;
+  librarySets = ./library_sets.json;
   libraries = loader_lock.libraries ++ game_lock.libraries;
 }
@@ -19,6 +19,7 @@ let
 
   loaderLocks = lib.importJSON ./loader_locks.json;
   libraryLocks = lib.importJSON ./library_locks.json;
+  librarySets = lib.importJSON ./library_sets.json;
   gameLocks = lib.importJSON ./game_locks.json;
 
   packages = mapAttrsToList (
@@ -34,6 +35,8 @@ let
 
           build = build // {
             version = buildVersion;
+            # Builds only lock their own libraries, and share the rest in a set
+            libraries = librarySets.${build.librarySet} ++ build.libraries;
           };
           gameVersion = gameLocks.${gameVersion} // {
             version = gameVersion;
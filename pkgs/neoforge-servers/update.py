@@ -1,35 +1,58 @@
 #!/usr/bin/env nix-shell
-#!nix-shell -i python3 -p python3Packages.packaging python3Packages.requests python3Packages.requests-cache
+#!nix-shell -i python3 -p python3Packages.h2 python3Packages.httpx python3Packages.packaging python3Packages.requests python3Packages.requests-cache
 
 import argparse
-import base64
 import concurrent.futures
-import json
+import multiprocessing
+import os
 import re
 import subprocess
-import zipfile
-from collections import defaultdict
+import sys
+from collections import defaultdict, deque
 from pathlib import Path
 from typing import Any, NotRequired, TypedDict
 
 import requests
 import requests_cache
 from packaging.version import InvalidVersion, Version
-from requests.adapters import HTTPAdapter, Retry
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from update_lib.aio import fetch_all
+from update_lib.cli import add_common_args
+from update_lib.client import IMMUTABLE, MAVEN_CHECKSUMS, make_client, prune_cache
+from update_lib.hashing import sri_hash
+from update_lib.listings import ListingValidators, get_listing
+from update_lib.locks import intern, load_lock, write_lock
+from update_lib.mojang import MANIFEST as MINECRAFT_MANIFEST
+from update_lib.mojang import VERSION_JSONS, get_manifest, get_version_jsons
+from update_lib.remote_zip import (
+    RangesNotSupported,
+    load_json_entries,
+    open_remote_zip,
+    read_raw_entry,
+)
 
 # Versions before 20.5 do not always support the "fat jar" feature. As such,
 # they always try to download server mappings, and there's no way to bypass it.
 MIN_SUPPORTED_VERSION = Version("20.4.240")
 
-MINECRAFT_MANIFEST = "https://launchermeta.mojang.com/mc/game/version_manifest_v2.json"
 NEOFORGE_API = (
     "https://maven.neoforged.net/api/maven/versions/releases/net/neoforged/neoforge"
 )
 NEOFORGE_MAVEN = "https://maven.neoforged.net/releases/net/neoforged/neoforge"
 
-TIMEOUT = 5
-RETRIES = 5
+# Installers are fetched on threads, but parsed in processes
 THREADS = 8
+PROCESSES = os.cpu_count() or 1
+
+# The files in the installer that list the libraries
+INSTALLER_PROFILES = ["install_profile.json", "version.json"]
+
+# Version JSONs and checksums never change, unlike the version listings
+CACHE_POLICY = {
+    **VERSION_JSONS,
+    MAVEN_CHECKSUMS: IMMUTABLE,
+}
 
 
 class FetchUrl(TypedDict):
@@ -44,41 +67,19 @@ class GameVersionLock(TypedDict):
 
 class LoaderLock(TypedDict):
     src: FetchUrl
+    # The build's own libraries, on top of those in the library set
     libraries: list[str]
+    librarySet: str
 
 
 # game version -> build version -> version details
 LoaderLocks = dict[str, dict[str, LoaderLock]]
 
 
-class TimeoutHTTPAdapter(HTTPAdapter):
-    def __init__(self, *args, **kwargs):
-        self.timeout = TIMEOUT
-        if "timeout" in kwargs:
-            self.timeout = kwargs["timeout"]
-            del kwargs["timeout"]
-        super().__init__(*args, **kwargs)
-
-    def send(self, request, **kwargs):
-        timeout = kwargs.get("timeout")
-        if timeout is None:
-            kwargs["timeout"] = self.timeout
-        return super().send(request, **kwargs)
-
-
-def make_client() -> requests_cache.CachedSession:
-    # configure a cache for faster local development
-    # mostly for ".sha256" files that should never change
-    client = requests_cache.CachedSession(backend="filesystem", cache_control=True)
-    retries = Retry(
-        total=RETRIES, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504]
-    )
-    client.mount("https://", TimeoutHTTPAdapter(max_retries=retries))
-    return client
-
-
-def sri_hash(alg: str, hex: str):
-    return f"{alg}-{base64.b64encode(bytes.fromhex(hex)).decode('utf-8')}"
+# library set ID -> libraries
+# Most builds share their libraries with many others, bar their own jar, so the
+# shared libraries are stored once here rather than in every build.
+LibrarySets = dict[str, list[str]]
 
 
 def minecraft_version(version: Version) -> str:
@@ -99,20 +100,10 @@ def minecraft_version(version: Version) -> str:
 
 def fetch_game_versions(client: requests_cache.CachedSession) -> dict[str, str]:
     print("Fetching game versions")
-    response = client.get(MINECRAFT_MANIFEST, expire_after=requests_cache.DO_NOT_CACHE)
-    response.raise_for_status()
-    data = response.json()
-    return {v["id"]: v["url"] for v in data["versions"]}
-
+    return {id: v["url"] for id, v in get_manifest(client).items()}
 
-def fetch_mappings_hash(
-    client: requests_cache.CachedSession, url: str
-) -> GameVersionLock:
-    print(f"Fetching manifest: {url}")
-    response = client.get(url)
-    response.raise_for_status()
-    data = response.json()
 
+def mappings_hash(data: dict[str, Any]) -> GameVersionLock:
     # Mappings are no longer required as of 26.x
     if "server_mappings" not in data["downloads"]:
         return GameVersionLock()
@@ -127,20 +118,37 @@ def fetch_mappings_hash(
     )
 
 
-def fetch_installer_hash(client: requests.Session, version: str):
-    url = f"{NEOFORGE_MAVEN}/{version}/neoforge-{version}-installer.jar"
-    hash_url = f"{url}.sha256"
-    response = client.get(hash_url)
-    response.raise_for_status()
-    return FetchUrl(
-        url=url,
-        hash=sri_hash("sha256", response.text),
-    )
+def fetch_installer_hashes(
+    client: requests.Session, versions: list[str]
+) -> list[FetchUrl]:
+    print(f"Fetching {len(versions)} installer hashes")
+    urls = [
+        f"{NEOFORGE_MAVEN}/{version}/neoforge-{version}-installer.jar"
+        for version in versions
+    ]
+    hashes = fetch_all(client, [f"{url}.sha256" for url in urls], parse=bytes.decode)
+    return [
+        FetchUrl(
+            url=url,
+            hash=sri_hash("sha256", hash),
+        )
+        for url, hash in zip(urls, hashes)
+    ]
+
 
+def fetch_installer_profiles(client: requests.Session, src: FetchUrl):
+    """
+    Fetch the profiles listing the libraries of an installer, without parsing
+    them, which is left to `load_json_entries`
+    Returns either the raw profile entries, or the path to the whole installer
+    """
+    # Only the profiles are needed, so try to avoid fetching the whole jar
+    try:
+        with open_remote_zip(client, src["url"]) as zf:
+            return {name: read_raw_entry(zf, name) for name in INSTALLER_PROFILES}
+    except RangesNotSupported as e:
+        print(f"{e}, fetching the whole installer")
 
-def fetch_library_hashes(src: FetchUrl) -> dict[str, FetchUrl]:
-    # the installer jar is used by the build derivation, so we might as well
-    # use nix to fetch/cache it ahead of time
     proc = subprocess.run(
         ["nix-prefetch-url", src["url"], src["hash"], "--print-path"],
         check=True,
@@ -148,8 +156,10 @@ def fetch_library_hashes(src: FetchUrl) -> dict[str, FetchUrl]:
         stdout=subprocess.PIPE,
         stderr=subprocess.STDOUT,
     )
-    store_path = proc.stdout.splitlines()[1]
+    return proc.stdout.splitlines()[1]
+
 
+def library_hashes(profiles: list[dict[str, Any]]) -> dict[str, FetchUrl]:
     def library_src(library: dict[str, Any]):
         artifact = library["downloads"]["artifact"]
         return FetchUrl(
@@ -157,16 +167,11 @@ def fetch_library_hashes(src: FetchUrl) -> dict[str, FetchUrl]:
             hash=sri_hash("sha1", artifact["sha1"]),
         )
 
-    with zipfile.ZipFile(store_path, "r") as zf:
-        with zf.open("install_profile.json", "r") as f:
-            profile_data = json.load(f)
-            libraries = profile_data["libraries"]
-
-        with zf.open("version.json", "r") as f:
-            version_data = json.load(f)
-            libraries += version_data["libraries"]
-
-    return {str(lib["name"]): library_src(lib) for lib in libraries}
+    return {
+        str(lib["name"]): library_src(lib)
+        for profile in profiles
+        for lib in profile["libraries"]
+    }
 
 
 def fetch_loader_versions(
@@ -174,11 +179,9 @@ def fetch_loader_versions(
     game_manifest: dict[str, str],
 ) -> dict[str, list[str]]:  # game version -> build versions
     print("Fetching installer versions")
-    response = client.get(NEOFORGE_API, expire_after=requests_cache.DO_NOT_CACHE)
-    response.raise_for_status()
+    data = get_listing(client, NEOFORGE_API, expire_after=requests_cache.DO_NOT_CACHE)
 
     versions = defaultdict(list)
-    data = response.json()
     for version in data["versions"]:
         try:
             version = Version(version)
@@ -202,26 +205,46 @@ def fetch_loader_versions(
     return versions
 
 
+def intern_libraries(
+    build_version: str, libraries: list[str], library_sets: LibrarySets
+) -> tuple[str, list[str]]:
+    """
+    Split the libraries of a build into the build's own libraries, and the rest,
+    which are added to `library_sets` under an ID derived from their contents
+    Returns the ID of the library set and the build's own libraries
+    """
+    own_prefix = f"net.neoforged:neoforge:{build_version}:"
+    own = [library for library in libraries if library.startswith(own_prefix)]
+    shared = sorted(library for library in libraries if library not in own)
+    return intern(shared, library_sets), own
+
+
 def main(
     loader_versions: LoaderLocks,
     game_versions: dict[str, GameVersionLock],
     library_versions: dict[str, FetchUrl],
+    library_sets: LibrarySets,
     version_regex,
     client,
+    threads=THREADS,
+    processes=PROCESSES,
 ):
     print("Starting fetch")
 
     game_manifest = fetch_game_versions(client)
     loader_manifest = fetch_loader_versions(client, game_manifest)
 
+    new_game_versions = [v for v in loader_manifest if v not in game_versions]
+    print(f"Fetching {len(new_game_versions)} game version manifests")
+    for game_version, data in zip(
+        new_game_versions,
+        get_version_jsons(client, [game_manifest[v] for v in new_game_versions]),
+    ):
+        game_versions[game_version] = mappings_hash(data)
+
     to_fetch = []
 
     for game_version, build_versions in loader_manifest.items():
-        if game_version not in game_versions:
-            game_versions[game_version] = fetch_mappings_hash(
-                client, game_manifest[game_version]
-            )
-
         for build_version in build_versions:
             if re.match(version_regex, build_version) is None:
                 print(f"Skip fetching {build_version}: does not match --version")
@@ -233,76 +256,130 @@ def main(
                 to_fetch.append((game_version, build_version))
 
     print(f"Fetching {len(to_fetch)} loader versions...")
+    completed = True
 
     def fetch_build(versions: tuple[str, str]):
         game_version, version = versions
         print(f"Fetching {version}")
-        installer = fetch_installer_hash(client, version)
-        return game_version, version, installer, fetch_library_hashes(installer)
+        installer = installers[versions]
+        return (
+            game_version,
+            version,
+            installer,
+            fetch_installer_profiles(client, installer),
+        )
+
+    def lock_build(game_version, version, src, parsed):
+        library_srcs = library_hashes(parsed.result())
+        if game_version not in loader_versions:
+            loader_versions[game_version] = {}
+        set_id, own = intern_libraries(
+            version, sorted(library_srcs.keys()), library_sets
+        )
+        loader_versions[game_version][version] = LoaderLock(
+            libraries=own,
+            librarySet=set_id,
+            src=src,
+        )
+        library_versions.update(library_srcs)
 
     try:
-        with concurrent.futures.ThreadPoolExecutor(max_workers=THREADS) as p:
-            for game_version, version, src, library_srcs in p.map(
+        installers = dict(
+            zip(to_fetch, fetch_installer_hashes(client, [v for _, v in to_fetch]))
+        )
+
+        with (
+            concurrent.futures.ThreadPoolExecutor(max_workers=threads) as io_pool,
+            # Not forked, as other updaters may be running in threads of this
+            # process, e.g. under update-all.py
+            concurrent.futures.ProcessPoolExecutor(
+                max_workers=processes,
+                mp_context=multiprocessing.get_context("forkserver"),
+            ) as cpu_pool,
+        ):
+            # Builds are locked in order as soon as they are parsed, so an
+            # interrupted run keeps everything before the first unfinished one
+            pending = deque()
+            for game_version, version, src, profiles in io_pool.map(
                 fetch_build, to_fetch
             ):
-                if game_version not in loader_versions:
-                    loader_versions[game_version] = {}
-                loader_versions[game_version][version] = LoaderLock(
-                    libraries=sorted(library_srcs.keys()),
-                    src=src,
+                parsed = cpu_pool.submit(
+                    load_json_entries, profiles, INSTALLER_PROFILES
                 )
-                library_versions |= library_srcs
+                pending.append((game_version, version, src, parsed))
+                while pending and pending[0][3].done():
+                    lock_build(*pending.popleft())
+            while pending:
+                lock_build(*pending.popleft())
     except KeyboardInterrupt:
         print("Cancelled fetching. Writing and exiting")
+        completed = False
 
-    return (loader_versions, game_versions, library_versions)
+    return (loader_versions, game_versions, library_versions, completed)
 
 
-if __name__ == "__main__":
+def parse_args(argv=None):
     parser = argparse.ArgumentParser()
+    add_common_args(parser)
     parser.add_argument("--version", type=str, default=r".*", required=False)
-    args = parser.parse_args()
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=THREADS,
+        help="maximum number of installers to fetch concurrently",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=PROCESSES,
+        help="maximum number of processes parsing installers",
+    )
+    return parser.parse_args(argv)
+
 
+def update(args, client):
+    """
+    Update the loader, game and library locks with the builds matching
+    `--version`
+    """
     folder = Path(__file__).parent
     loader_path = folder / "loader_locks.json"
     game_path = folder / "game_locks.json"
     library_path = folder / "library_locks.json"
-    with (
-        open(loader_path, "r") as loader_locks,
-        open(game_path, "r") as game_locks,
-        open(library_path, "r") as library_locks,
-    ):
-        loader_versions = (
-            {} if loader_path.stat().st_size == 0 else json.load(loader_locks)
-        )
-        game_versions = {} if game_path.stat().st_size == 0 else json.load(game_locks)
-        library_versions = (
-            {} if library_path.stat().st_size == 0 else json.load(library_locks)
-        )
-
-    (loader_versions, game_versions, library_versions) = main(
+    library_sets_path = folder / "library_sets.json"
+    loader_versions = load_lock(loader_path)
+    game_versions = load_lock(game_path)
+    library_versions = load_lock(library_path)
+    library_sets = load_lock(library_sets_path)
+
+    # Only skip full runs, since a previous run may have skipped other versions
+    listings = ListingValidators(folder.name, args.force or args.version != r".*")
+    if listings.unchanged(client, MINECRAFT_MANIFEST, NEOFORGE_API):
+        print("Versions unchanged since the last run, nothing to do")
+        return
+
+    (loader_versions, game_versions, library_versions, completed) = main(
         loader_versions,
         game_versions,
         library_versions,
+        library_sets,
         args.version,
-        make_client(),
+        client,
+        args.threads,
+        args.processes,
     )
 
-    with (
-        open(loader_path, "w") as loader_locks,
-        open(game_path, "w") as game_locks,
-        open(library_path, "w") as library_locks,
-    ):
-        json.dump(
-            loader_versions,
-            loader_locks,
-            indent=2,
-            sort_keys=True,
-        )
-        json.dump(game_versions, game_locks, indent=2, sort_keys=True)
-        json.dump(
-            library_versions,
-            library_locks,
-            indent=2,
-            sort_keys=True,
-        )
+    # Libraries first, so the loader lock never references missing ones
+    write_lock(library_path, library_versions, newline=False, sort_keys=True)
+    write_lock(library_sets_path, library_sets, newline=False, sort_keys=True)
+    write_lock(game_path, game_versions, newline=False, sort_keys=True)
+    write_lock(loader_path, loader_versions, newline=False, sort_keys=True)
+    if completed:
+        listings.save()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    client = make_client(CACHE_POLICY, args.threads, args.per_host)
+    update(args, client)
+    prune_cache(client)
@@ -1,62 +1,92 @@
 #!/usr/bin/env nix-shell
-#!nix-shell -i python3 -p python3Packages.requests
+#!nix-shell -i python3 -p python3Packages.h2 python3Packages.httpx python3Packages.requests python3Packages.requests-cache
 
-import json
+import argparse
+import sys
 from pathlib import Path
 
-import requests
-from requests.adapters import HTTPAdapter, Retry
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from update_lib.aio import fetch_all
+from update_lib.cli import add_common_args
+from update_lib.client import make_client, prune_cache
+from update_lib.listings import ListingValidators, get_listing
+from update_lib.locks import load_lock, write_lock
 
 ENDPOINT = "https://fill.papermc.io/v3/projects/paper"
 
-TIMEOUT = 5
-RETRIES = 5
-
-
-class TimeoutHTTPAdapter(HTTPAdapter):
-    def __init__(self, *args, **kwargs):
-        self.timeout = TIMEOUT
-        if "timeout" in kwargs:
-            self.timeout = kwargs["timeout"]
-            del kwargs["timeout"]
-        super().__init__(*args, **kwargs)
-
-    def send(self, request, **kwargs):
-        timeout = kwargs.get("timeout")
-        if timeout is None:
-            kwargs["timeout"] = self.timeout
-        return super().send(request, **kwargs)
-
-
-def make_client():
-    http = requests.Session()
-    retries = Retry(
-        total=RETRIES, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504]
-    )
-    http.mount("https://", TimeoutHTTPAdapter(max_retries=retries))
-    return http
+# Build listings are always fetched fresh, so nothing is cached
+CACHE_POLICY = {}
 
 
 def get_game_versions(client):
+    """
+    Returns a dict of {version: listing}, where the listing is in the format
+    {"version": {"id": string, "support": {"status": string}, ...}, "builds": [int]}
+    """
     print("Fetching game versions")
-    data = client.get(f"{ENDPOINT}/versions").json()
+    data = get_listing(client, f"{ENDPOINT}/versions")
     # NOTE: Improperly sorts versions, but is at least consistent
-    return sorted(v["version"]["id"] for v in data["versions"])
-
-
-def get_builds(version, client):
-    print(f"Fetching builds for {version}")
-    data = client.get(f"{ENDPOINT}/versions/{version}/builds").json()
-    return sorted(data, key=lambda build: build["id"])
-
-
-def main(lock, client):
+    return {
+        v["version"]["id"]: v
+        for v in sorted(data["versions"], key=lambda v: v["version"]["id"])
+    }
+
+
+def get_all_builds(versions, client):
+    """
+    Fetch the builds of each version concurrently
+    Returns a dict of {version: builds}, in the same order as `versions`
+    """
+    print(f"Fetching builds for {len(versions)} versions")
+    urls = [f"{ENDPOINT}/versions/{version}/builds" for version in versions]
+    return {
+        version: sorted(data, key=lambda build: build["id"])
+        for version, data in zip(versions, fetch_all(client, urls))
+    }
+
+
+def is_up_to_date(listing, locked_builds):
+    """
+    Whether the locked builds of a version are still current, so its build list
+    doesn't need to be fetched again
+    """
+    if "builds" in listing:
+        return {str(build) for build in listing["builds"]} <= locked_builds.keys()
+
+    # Without a build list, only trust versions that won't get any more builds
+    return listing["version"].get("support", {}).get("status") == "UNSUPPORTED"
+
+
+def main(client, existing=None):
+    """
+    Fetch the builds of every game version and return the new lock.
+    If the existing lock is given, versions with no new builds are kept from it
+    instead of being fetched again.
+    """
     output = {}
     print("Starting fetch")
 
-    for version in get_game_versions(client):
+    versions = get_game_versions(client)
+    to_fetch = []
+    for version, listing in versions.items():
+        if existing is not None:
+            if listing.get("builds", None) == []:
+                continue
+            if version in existing and is_up_to_date(listing, existing[version]):
+                print(f"Builds for {version} already locked")
+                continue
+        to_fetch.append(version)
+
+    fetched = get_all_builds(to_fetch, client)
+
+    for version in versions:
+        if version not in fetched:
+            if existing is not None and version in existing:
+                output[version] = existing[version]
+            continue
+
         version_builds = {}
-        for build in get_builds(version, client):
+        for build in fetched[version]:
             build_number = build["id"]
             build_sha256 = build["downloads"]["server:default"]["checksums"]["sha256"]
             build_url = build["downloads"]["server:default"]["url"]
@@ -67,11 +97,40 @@ def main(lock, client):
         if version_builds:
             output[version] = version_builds
 
-    json.dump(output, lock, indent=2)
-    lock.write("\n")
+    return output
 
 
-if __name__ == "__main__":
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser()
+    add_common_args(parser)
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="fetch the builds of every version, ignoring the existing lock",
+    )
+    return parser.parse_args(argv)
+
+
+def update(args, client):
+    """
+    Update the build lock, from scratch if `--full` is given
+    """
     folder = Path(__file__).parent
     lock_path = folder / "lock.json"
-    main(open(lock_path, "w"), make_client())
+
+    existing = None if args.full else load_lock(lock_path)
+
+    listings = ListingValidators(folder.name, args.force or args.full)
+    if listings.unchanged(client, f"{ENDPOINT}/versions"):
+        print("Versions unchanged since the last run, nothing to do")
+        return
+
+    write_lock(lock_path, main(client, existing))
+    listings.save()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    client = make_client(CACHE_POLICY, per_host=args.per_host)
+    update(args, client)
+    prune_cache(client)
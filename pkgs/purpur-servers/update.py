@@ -1,109 +1,226 @@
 #!/usr/bin/env nix-shell
-#!nix-shell -i python3 -p python3Packages.requests  python3Packages.progressbar
-
-import json
-import requests
-import hashlib
+#!nix-shell -i python3 -p python3Packages.h2 python3Packages.httpx python3Packages.requests python3Packages.requests-cache python3Packages.progressbar
+
+import argparse
+import asyncio
+import concurrent.futures
+import random
+import re
+import sys
+from datetime import timedelta
 from pathlib import Path
-from requests.adapters import HTTPAdapter, Retry
 import time
 import progressbar
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from update_lib.aio import fetch_all, get_fetcher
+from update_lib.cli import add_common_args
+from update_lib.client import IMMUTABLE, make_client, prune_cache
+from update_lib.locks import load_lock, write_lock
+from update_lib.negative import NegativeCache
 
 ENDPOINT = "https://api.purpurmc.org/v2/purpur"
 
-def load_lock(path):
-    print("Loading lock file")
-    if not path.exists():
-        print("└ Creating one from scratch")
-        return {}
-    with open(path, "r+") as f:
-        data = json.load(f)
-    return data
+HASH_THREADS = 4
+
+# Failed builds are never rebuilt, so there is little point checking them often
+RETRY_AFTER = timedelta(days=365)
 
-def save_lock(path, data):
-    with open(path, "w") as f:
-        json.dump(data, f, indent=2)
+# Save progress after this many builds, or this many seconds, whichever is first
+CHECKPOINT_BUILDS = 25
+CHECKPOINT_INTERVAL = 60
 
+# Build info never changes, unlike the version and build listings
+CACHE_POLICY = {
+    re.compile(r"api\.purpurmc\.org/v2/purpur/[^/]+/\d+$"): IMMUTABLE,
+}
 
 
-def get_versions():
+def get_versions(client):
     print("Fetching Versions")
-    versions = requests.get(ENDPOINT).json()["versions"]
+    versions = client.get(ENDPOINT).json()["versions"]
     print(f"└ Total of {len(versions)} versions")
     return versions
 
-def get_builds(version):
+
+def get_builds(client, version):
     print(f"Fetching {version} version builds")
-    builds = requests.get(f"{ENDPOINT}/{version}").json()["builds"]["all"]
+    builds = client.get(f"{ENDPOINT}/{version}").json()["builds"]["all"]
     print(f"└ Total of {len(builds)} builds")
     return builds
 
-def get_build_info(version, build):
-    print(f" └ Fetching {build} build info")
-    info = requests.get(f"{ENDPOINT}/{version}/{build}").json()
-    return info
-
-def get_build_sha256(build_url):
-    print(f"    └ Generating SHA256")
-    sha256 = hashlib.sha256()
-    with requests.get(build_url, stream=True) as response:
-        response.raise_for_status()
-        for chunk in response.iter_content(8192):
-            sha256.update(chunk)
-    return sha256.hexdigest()
-
-def main(lock_path, bad_path):
-    lock_data = load_lock(lock_path)
-    bad_data = load_lock(bad_path)
-    versions = get_versions();
-    for version in versions:
-
-        # When version doesn't exist in lock file
-        if version not in lock_data:
-            lock_data[version] = {}
-            bad_data[version] = []
-        builds = get_builds(version)
-        updated = 0
-        for build in builds:
-            if build in lock_data[version]:
-                continue
-            if build in bad_data[version]:
-                continue
-
-            build_info = get_build_info(version, build)
-
-
-            if build_info["result"] == "FAILURE":
-                print(f"   └ Failed to get build info of {build}")
-                bad_data[version].append(build)                    
-                continue
-
-            build_download = f"{ENDPOINT}/{version}/{build}/download"
-            build_sha256 = get_build_sha256(build_download)
 
-            updated += 1
-            lock_data[version][build] = {
-                "sha256": build_sha256
-            }
-
-
-    save_lock(bad_path, bad_data)
-    save_lock(lock_path, lock_data)
-    print(f"-> Updated {updated} builds of version {version}")
+def get_build_infos(client, version, builds):
+    print(f" └ Fetching info of {len(builds)} {version} builds")
+    urls = [f"{ENDPOINT}/{version}/{build}" for build in builds]
+    return fetch_all(client, urls)
+
+
+class ChecksumMismatch(Exception):
+    pass
+
+
+async def get_build_sha256(fetcher, hash_limit, build_url, published):
+    """
+    Download the build to generate its SHA256, checking it against the digests
+    published by the API along the way (`published` is {algorithm: hex digest})
+    At most `hash_limit` builds are downloaded at once.
+    """
+    async with hash_limit:
+        print(f"    └ Generating SHA256 of {build_url}")
+        hashes = await fetcher.hash_url(build_url, {"sha256", *published})
+    for alg, digest in published.items():
+        if hashes[alg].hexdigest() != digest.lower():
+            raise ChecksumMismatch(f"{alg} of {build_url} does not match the API")
+    return hashes["sha256"].hexdigest()
+
+
+def queue_build(fetcher, hash_limit, version, build, build_info, verify_fraction=0):
+    """
+    Queue the build to be hashed on the `Fetcher` if it succeeded
+    If the API publishes a SHA256 for the build, it is used directly, and only
+    a random `verify_fraction` of those builds are downloaded to check it
+    Returns the future of the hash, or None if the build failed
+    """
+    if build_info["result"] == "FAILURE":
+        print(f"   └ Failed to get build info of {version} build {build}")
+        return None
+
+    build_download = f"{ENDPOINT}/{version}/{build}/download"
+    # As of writing, the API only publishes an MD5, which fetchurl can't use,
+    # but it is still cheap to check while hashing
+    published = {
+        alg: build_info[alg] for alg in ("sha256", "md5") if build_info.get(alg)
+    }
+
+    if "sha256" in published and random.random() >= verify_fraction:
+        print(f"   └ Using published SHA256 of {version} build {build}")
+        future = concurrent.futures.Future()
+        future.set_result(published["sha256"].lower())
+        return future
+
+    return fetcher.submit(
+        get_build_sha256(fetcher, hash_limit, build_download, published)
+    )
+
+
+def main(
+    lock_path,
+    bad,
+    client,
+    hash_threads=HASH_THREADS,
+    verify_fraction=0,
+):
+    lock_data = load_lock(lock_path)
 
+    fetcher = get_fetcher(client)
+    hash_limit = asyncio.Semaphore(hash_threads)
+
+    # Builds are hashed out of order, but committed to the locks in order,
+    # so every checkpoint is exactly what a serial run would have saved
+    pending = []
+    updated = 0
+
+    def checkpoint(verbose=False):
+        bad.save(verbose=verbose)
+        write_lock(lock_path, lock_data, newline=False, verbose=verbose)
+
+    try:
+        for version in get_versions(client):
+            lock_data.setdefault(version, {})
+
+            builds = [
+                build
+                for build in get_builds(client, version)
+                if build not in lock_data[version] and f"{version}/{build}" not in bad
+            ]
+            build_infos = get_build_infos(client, version, builds)
+
+            for build, build_info in zip(builds, build_infos):
+                hash_future = queue_build(
+                    fetcher, hash_limit, version, build, build_info, verify_fraction
+                )
+                pending.append((version, build, hash_future))
+
+        print(f"Processing {len(pending)} builds")
+        since_checkpoint, last_checkpoint = 0, time.monotonic()
+        for version, build, hash_future in pending:
+            if hash_future is None:
+                bad.add(f"{version}/{build}")
+            else:
+                try:
+                    lock_data[version][build] = {"sha256": hash_future.result()}
+                    bad.discard(f"{version}/{build}")
+                    updated += 1
+                except ChecksumMismatch as e:
+                    # Leave it out of both locks, so it's tried again next time
+                    print(f"   └ {e}, skipping")
+
+            since_checkpoint += 1
+            if (
+                since_checkpoint >= CHECKPOINT_BUILDS
+                or time.monotonic() - last_checkpoint >= CHECKPOINT_INTERVAL
+            ):
+                checkpoint()
+                since_checkpoint, last_checkpoint = 0, time.monotonic()
+    except KeyboardInterrupt:
+        print("Cancelled fetching. Writing and exiting")
+    finally:
+        for _, _, hash_future in pending:
+            if hash_future is not None:
+                hash_future.cancel()
+        checkpoint(verbose=True)
+
+    print(f"-> Updated {updated} builds")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser()
+    add_common_args(parser, listings=False)
+    parser.add_argument(
+        "--hash-threads",
+        type=int,
+        default=HASH_THREADS,
+        help="maximum number of builds to download and hash concurrently",
+    )
+    parser.add_argument(
+        "--retry-after",
+        type=int,
+        default=RETRY_AFTER.days,
+        help="days after which to check failed builds again",
+    )
+    parser.add_argument(
+        "--verify-fraction",
+        type=float,
+        default=0,
+        help="fraction of builds with a published SHA256 to download and verify",
+    )
+    return parser.parse_args(argv)
+
+
+def update(args, client):
+    """
+    Update the build lock, checkpointing as builds are hashed, and the builds
+    known to have failed
+    """
+    folder = Path(__file__).parent
+    lock_path = Path(folder / "lock.json")
+    # Failed builds, as {"<version>/<build>": date found}
+    bad = NegativeCache(Path(folder / "bad.json"), timedelta(days=args.retry_after))
+    main(
+        lock_path,
+        bad,
+        client,
+        args.hash_threads,
+        args.verify_fraction,
+    )
 
-            
-        
 
 if __name__ == "__main__":
+    args = parse_args()
     start = time.process_time()
-    folder = Path(__file__).parent
-    lock_path = Path(folder / "lock.json")
-    # Saving builds not found
-    bad_path = Path(folder / "bad.json")
-    main(lock_path, bad_path)
+    client = make_client(CACHE_POLICY, per_host=args.per_host)
+    update(args, client)
+    prune_cache(client)
     end = time.process_time() - start
     print(f"Finished {round(end, 2)}s")
-
-
@@ -12,6 +12,7 @@ mkTextileLoader {
   loaderName = "quilt";
   inherit loaderVersion gameVersion;
   serverLaunch = "org.quiltmc.loader.impl.launch.server.QuiltServerLauncher";
-  inherit (loader_lock) mainClass;
+  inherit (loader_lock) mainClass librarySet;
+  librarySets = ./library_sets.json;
   libraries = loader_lock.libraries ++ game_lock.libraries;
 }
@@ -1,14 +1,24 @@
 #!/usr/bin/env nix-shell
-#!nix-shell -i python3 -p python3Packages.requests python3Packages.jq
+#!nix-shell -i python3 -p python3Packages.h2 python3Packages.httpx python3Packages.requests python3Packages.requests-cache python3Packages.jq
 
-import json
 import logging
 import re
-import subprocess
+import sys
 from pathlib import Path
 
 import jq
-import requests
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from update_lib import textile
+from update_lib.aio import fetch_all
+from update_lib.client import (
+    IMMUTABLE,
+    MAVEN_CHECKSUMS,
+    STABLE,
+    make_client,
+    prune_cache,
+)
+from update_lib.listings import get_listing
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger()
@@ -73,29 +83,36 @@ def GAME_VERSION_FILTER(version):
 # GAME_VERSION_FILTER = lambda version: version["stable"] and versiontuple(version["version"]) > (1, 18, 2)
 
 
-def get(*args: str):
-    return requests.get("/".join((ENDPOINT,) + args)).json()
+# Per-version metadata doesn't change once published, unlike the listings
+CACHE_POLICY = {
+    f"{ENDPOINT}/*/*": STABLE,
+    MAVEN_CHECKSUMS: IMMUTABLE,
+}
+
+
+def get(client, *args: str):
+    return get_listing(client, "/".join((ENDPOINT,) + args))
 
 
-def get_game_versions():
+def get_game_versions(client):
     """
     Returns a list of game versions that the Fabric loader supports, filtered
     using the GAME_VERSION_FILTER above. The `version` variable is in the format
     {"verson": string, "stable": bool}
     """
     logger.info("Fetching game versions")
-    data = get("game")
+    data = get(client, "game")
     return [version["version"] for version in data if GAME_VERSION_FILTER(version)]
 
 
-def get_loader_versions():
+def get_loader_versions(client):
     """
     Returns a list of the Fabric loader versions that should be packaged, filtered
     using the LOADER_VERSION_FILTER above. The `version` variable is in the format
     {"separater": string, "build": int, "maven": string, "version": string, "stable": bool}
     """
     logger.info("Fetching loader versions")
-    data = get("loader")
+    data = get(client, "loader")
     return [version["version"] for version in data if LOADER_VERSION_FILTER(version)]
 
 
@@ -108,175 +125,60 @@ PROCESS_LOADER_VERSION = jq.compile(
 )
 
 
-def fetch_loader_version(loader_version):
+def fetch_loader_versions(client, loader_versions):
     """
-    Return the loader information for a given loader version
+    Return the loader information for the given loader versions, fetched
+    concurrently, as a dict of {loader version: information}
     """
     # Quilt's API doesn't expose loader information without a game version
     game_version = "1.19"
 
-    return PROCESS_LOADER_VERSION.input_value(
-        get("loader", game_version, loader_version)
-    ).first()
+    urls = [
+        "/".join((ENDPOINT, "loader", game_version, loader_version))
+        for loader_version in loader_versions
+    ]
+    return {
+        loader_version: PROCESS_LOADER_VERSION.input_value(data).first()
+        for loader_version, data in zip(loader_versions, fetch_all(client, urls))
+    }
 
 
-def fetch_game_version(game_version):
+def get_mappings(client):
     """
-    Return game-version-specific libraries for a given game version
+    Returns a dict of {mapping: {game version: maven coordinate}} for each of
+    the VERSION_MAPPINGS, fetching each listing once
     """
-
-    libraries = []
-
-    for library in VERSION_MAPPINGS:
-        fetched = get(library, game_version)
-        if isinstance(fetched, list):  # TODO: compare against game_version
-            libraries.append({"name": fetched[0]["maven"], "url": MAVEN})
-
-    return {"libraries": libraries}
-
-
-def prefetch_libraries(logger, version_libraries, libraries):
-    logger = logger.getChild("libraries")
-    ret = []
-
-    for library in version_libraries:
-        name, url = library["name"], library["url"]
-
-        if name not in libraries or any(not v for v in libraries[name].values()):
-            logger.info(f"Fetching {name}")
-            ldir, lname, lversion = name.split(":")
-            lfilename = f"{lname}-{lversion}.jar"
-            lurl = "/".join(
-                (
-                    url.rstrip("/"),
-                    ldir.replace(".", "/"),
-                    lname,
-                    lversion,
-                    f"{lname}-{lversion}.jar",
-                )
-            )
-
-            lhash = subprocess.run(
-                ["nix-prefetch-url", lurl], capture_output=True, encoding="UTF-8"
-            ).stdout.rstrip("\n")
-
-            libraries[name] = {"name": lfilename, "url": lurl, "sha256": lhash}
-        else:
-            logger.debug(f"Using cached {name}")
-
-        ret.append(name)
-
-    return ret
+    logger.info("Fetching mappings")
+    return {
+        library: {
+            version["version"]: version["maven"] for version in get(client, library)
+        }
+        for library in VERSION_MAPPINGS
+    }
 
 
-def gen_loader_locks(logger, version, libraries):
+def game_version_libraries(mappings, game_version):
+    """
+    Return game-version-specific libraries for a given game version
     """
-    Return the lock information for a given loader version, returned in the format
-    {
-        "mainClass": string,
+    return {
         "libraries": [
-            {"name": string, "url": string, "sha256": string},
-            ...
+            {"name": mapping[game_version], "url": MAVEN}
+            for mapping in mappings.values()
+            if game_version in mapping
         ]
     }
-    """
-    ret = {
-        "mainClass": version["mainClass"],
-        "libraries": prefetch_libraries(logger, version["libraries"], libraries),
-    }
 
-    return ret
 
+parse_args = textile.parse_args
 
-def gen_game_locks(logger, version, libraries):
-    """
-    Return the lock information for a given loader version, returned in the format
-    {
-        "libraries": [
-            {"name": string, "url": string, "sha256": string},
-            ...
-        ]
-    }
-    """
-    return {"libraries": prefetch_libraries(logger, version["libraries"], libraries)}
 
-
-def main(
-    versions_loader, versions_game, libraries, loader_locks, game_locks, lib_locks
-):
-    """
-    Fetch the relevant information and update the lockfiles.
-    `versions` and `libraries` are data from the existing files, while
-    `locks` and `lib_locks` are file objects to be written to
-    """
-    loader_versions = get_loader_versions()
-    game_versions = get_game_versions()
-
-    logger.info("Starting fetch")
-    try:
-        logger.info("Fetching loader versions")
-        loader_logger = logger.getChild("loader")
-        for loader_version in loader_versions:
-            if not versions_loader.get(loader_version, None):
-                loader_logger.info(f"Fetching version: {loader_version}")
-                versions_loader[loader_version] = gen_loader_locks(
-                    loader_logger, fetch_loader_version(loader_version), libraries
-                )
-            else:
-                loader_logger.info(f"Version {loader_version} already locked")
-
-        logger.info("Fetching game versions")
-        game_logger = logger.getChild("game")
-        for game_version in game_versions:
-            if not versions_game.get(game_version, None):
-                game_logger.info(f"Fetching version: {game_version}")
-                versions_game[game_version] = gen_game_locks(
-                    game_logger, fetch_game_version(game_version), libraries
-                )
-            else:
-                game_logger.info(f"Version {game_version} already locked")
-
-    except KeyboardInterrupt:
-        logger.warning("Cancelled fetching, writing and exiting")
-
-    json.dump(versions_loader, loader_locks, indent=2)
-    json.dump(versions_game, game_locks, indent=2)
-    json.dump(libraries, lib_locks, indent=2)
-    loader_locks.write("\n")
-    game_locks.write("\n")
-    lib_locks.write("\n")
+def update(args, client):
+    textile.update(args, client, sys.modules[__name__])
 
 
 if __name__ == "__main__":
-    folder = Path(__file__).parent
-    llo = folder / "loader_locks.json"
-    glo = folder / "game_locks.json"
-    llo.touch()
-    glo.touch()
-
-    build_support_folder = folder.parent / "build-support"
-    li = build_support_folder / "libraries.json"
-    li.touch()
-
-    with (
-        open(llo, "r") as loader_locks,
-        open(glo, "r") as game_locks,
-        open(li, "r") as lib_locks,
-    ):
-        versions_loader = {} if llo.stat().st_size == 0 else json.load(loader_locks)
-        versions_game = {} if glo.stat().st_size == 0 else json.load(game_locks)
-        libraries = {} if li.stat().st_size == 0 else json.load(lib_locks)
-
-    with (
-        open(llo, "w") as loader_locks,
-        open(glo, "w") as game_locks,
-        open(li, "w") as lib_locks,
-    ):
-        main(
-            versions_loader,
-            versions_game,
-            libraries,
-            loader_locks,
-            game_locks,
-            lib_locks,
-        )
+    args = parse_args()
+    client = make_client(CACHE_POLICY, per_host=args.per_host)
+    update(args, client)
+    prune_cache(client)
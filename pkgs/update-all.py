@@ -0,0 +1,137 @@
+#!/usr/bin/env nix-shell
+#!nix-shell -i python3 -p python3Packages.h2 python3Packages.httpx python3Packages.jq python3Packages.packaging python3Packages.progressbar python3Packages.requests python3Packages.requests-cache
+
+# Runs the update scripts of every package, or just the given ones, concurrently
+# in one process, sharing one HTTP client and cache between them.
+# Each `pkgs/*/update.py` has to provide `parse_args(argv)` and
+# `update(args, client)`, and its `CACHE_POLICY`.
+
+import argparse
+import concurrent.futures
+import importlib.util
+import os
+import sys
+import time
+import traceback
+from pathlib import Path
+
+PKGS = Path(__file__).resolve().parent
+sys.path.insert(0, str(PKGS))
+from update_lib.client import PER_HOST, make_client, prune_cache
+
+
+def find_updaters():
+    """
+    Returns a dict of {package: path} of every update script
+    """
+    return {path.parent.name: path for path in sorted(PKGS.glob("*/update.py"))}
+
+
+def load_updater(name, path):
+    spec = importlib.util.spec_from_file_location(
+        f"update_{name.replace('-', '_')}", path
+    )
+    module = importlib.util.module_from_spec(spec)
+    # Registered like any imported module, so updaters can refer to themselves
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def run_updater(name, module, client, force=False):
+    """
+    Run an updater with its default arguments
+    Returns how long it took, in seconds
+    """
+    args = module.parse_args([])
+    if force and hasattr(args, "force"):
+        args.force = True
+
+    print(f"Starting {name}")
+    start = time.monotonic()
+    module.update(args, client)
+    return time.monotonic() - start
+
+
+def main(names, per_host=PER_HOST, force=False):
+    """
+    Run the given updaters concurrently, and print how long each of them took
+    Returns whether all of them succeeded
+    """
+    modules = {name: load_updater(name, path) for name, path in names.items()}
+
+    cache_policy = {}
+    for module in modules.values():
+        cache_policy |= module.CACHE_POLICY
+    client = make_client(cache_policy, per_host=per_host)
+
+    start = time.monotonic()
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(modules)) as p:
+        futures = {
+            name: p.submit(run_updater, name, module, client, force)
+            for name, module in modules.items()
+        }
+        for name, future in futures.items():
+            try:
+                results[name] = f"{future.result():.1f}s"
+            except Exception:
+                print(f"{name} failed:", file=sys.stderr)
+                traceback.print_exc()
+                results[name] = "failed"
+    total = time.monotonic() - start
+
+    prune_cache(client)
+
+    width = max(map(len, results))
+    print("\nTimings:")
+    for name, result in results.items():
+        print(f"  {name:<{width}}  {result:>8}")
+    print(f"  {'total':<{width}}  {total:>7.1f}s")
+
+    return "failed" not in results.values()
+
+
+if __name__ == "__main__":
+    updaters = find_updaters()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "packages",
+        nargs="*",
+        metavar="package",
+        help=f"packages to update, out of {', '.join(updaters)} (default: all)",
+    )
+    parser.add_argument(
+        "--per-host",
+        type=int,
+        default=PER_HOST,
+        help="maximum number of concurrent connections to each upstream",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="run even if upstream reports that nothing changed since the last run",
+    )
+    args = parser.parse_args()
+
+    for package in args.packages:
+        if package not in updaters:
+            parser.error(f"no update script for {package}")
+
+    try:
+        ok = main(
+            {
+                k: v
+                for k, v in updaters.items()
+                if not args.packages or k in args.packages
+            },
+            args.per_host,
+            args.force,
+        )
+    except KeyboardInterrupt:
+        # The updaters only handle interrupts on the main thread, so just stop.
+        # Locks are replaced atomically, so they are never left half-written.
+        print("Cancelled, exiting")
+        os._exit(130)
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,448 @@
+#!/usr/bin/env nix-shell
+#!nix-shell -i python3 -p python3Packages.h2 python3Packages.httpx python3Packages.jq python3Packages.packaging python3Packages.progressbar python3Packages.requests python3Packages.requests-cache
+
+# Benchmarks the update scripts offline, against a local stub of their upstreams
+# serving recorded responses, so that runs are comparable between commits.
+# Each updater is run on its own, in a fresh copy of `pkgs` with an empty HTTP
+# cache, and its wall time, requests, bytes received, subprocesses spawned and
+# peak memory are reported. Any further `--runs` reuse the copy and cache of the
+# first, and are reported separately as warm runs: the stub answers conditional
+# requests like upstream would, so they measure a run where nothing changed.
+#
+# Record the responses once with `--record`, which proxies the live upstreams
+# and saves whatever is missing, then run without it to replay them. Requests
+# for responses that weren't recorded get a 404, and are reported as misses.
+
+import argparse
+import email.utils
+import hashlib
+import http.server
+import json
+import os
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+PKGS = Path(__file__).resolve().parent
+sys.path.insert(0, str(PKGS))
+from update_lib.client import CACHE_DIR, TIMEOUT
+
+FIXTURES = CACHE_DIR / "bench-fixtures"
+
+# Response headers worth replaying, the rest describe the original connection
+RECORDED_HEADERS = ("Content-Type", "ETag", "Last-Modified")
+
+RANGE = re.compile(r"bytes=(\d*)-(\d*)")
+
+# Audit events raised when a process is started
+SPAWN_EVENTS = {
+    "os.exec",
+    "os.fork",
+    "os.posix_spawn",
+    "os.spawn",
+    "os.system",
+    "subprocess.Popen",
+}
+
+# Runs an update script as `__main__`, counting the processes it starts, and
+# writes the count to the file named by its first argument
+BOOTSTRAP = f"""
+import json, runpy, sys
+
+spawns = 0
+
+def audit(event, args):
+    global spawns
+    if event in {SPAWN_EVENTS!r}:
+        spawns += 1
+
+stats, script = sys.argv[1:3]
+sys.argv = sys.argv[2:]
+sys.addaudithook(audit)
+try:
+    runpy.run_path(script, run_name="__main__")
+finally:
+    with open(stats, "w") as f:
+        json.dump({{"spawns": spawns}}, f)
+"""
+
+
+class Fixtures:
+    """
+    Recorded responses, stored as a body and its metadata per URL
+    If `record` is set, responses that are missing are fetched from the live
+    upstream and saved first.
+    """
+
+    def __init__(self, path: Path, record: bool = False):
+        self.path = path
+        self.record = record
+        self.live = None
+        if record:
+            import requests
+
+            self.path.mkdir(parents=True, exist_ok=True)
+            self.live = requests.Session()
+
+    def _paths(self, url: str):
+        name = hashlib.sha256(url.encode()).hexdigest()
+        return self.path / f"{name}.json", self.path / f"{name}.body"
+
+    def get(self, url: str):
+        """
+        Returns a tuple of (status, headers, body) for the URL, or None if it
+        wasn't recorded
+        """
+        meta_path, body_path = self._paths(url)
+        if not meta_path.exists():
+            if not self.record:
+                return None
+            self._record(url)
+
+        meta = json.loads(meta_path.read_text())
+        return meta["status"], meta["headers"], body_path.read_bytes()
+
+    def _record(self, url: str):
+        # Redirects are followed, so the stub serves the final response directly
+        response = self.live.get(url, timeout=TIMEOUT * 12)
+        meta_path, body_path = self._paths(url)
+        body_path.write_bytes(response.content)
+        meta_path.write_text(
+            json.dumps(
+                {
+                    "url": url,
+                    "status": response.status_code,
+                    "headers": {
+                        k: response.headers[k]
+                        for k in RECORDED_HEADERS
+                        if k in response.headers
+                    },
+                }
+            )
+        )
+
+
+class StubUpstream(http.server.ThreadingHTTPServer):
+    """
+    Serves `fixtures` for requests of the form `/{host}/{path}`, as sent by
+    updaters with `NIX_MINECRAFT_UPDATE_UPSTREAM` set, counting the requests,
+    bytes sent and misses
+    """
+
+    daemon_threads = True
+
+    def __init__(self, fixtures: Fixtures):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.fixtures = fixtures
+        self.stats_lock = threading.Lock()
+        self.reset()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def reset(self):
+        with self.stats_lock:
+            self.requests = 0
+            self.bytes = 0
+            self.misses = set()
+
+    def handle_error(self, request, client_address):
+        # Updaters may drop connections they are done with
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def count(self, url: str, sent: int, missed: bool):
+        with self.stats_lock:
+            self.requests += 1
+            self.bytes += sent
+            if missed:
+                self.misses.add(url)
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = f"https:/{self.path}"
+        try:
+            fixture = self.server.fixtures.get(url)
+        except Exception as e:
+            print(f"Failed to record {url}: {e!r}", file=sys.stderr)
+            fixture = None
+
+        if fixture is None:
+            status, headers, body = 404, {}, b""
+        else:
+            status, headers, body = fixture
+            headers = dict(headers)
+            if status == 200 and self._not_modified(headers):
+                status, body = 304, b""
+            elif status == 200 and (range_ := self.headers.get("Range")):
+                status, body = self._range(range_, body, headers)
+
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        # A 304 has no body, but its Content-Length would describe the full one
+        if status != 304:
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count(url, len(body), fixture is None)
+
+    def _not_modified(self, headers: dict) -> bool:
+        """
+        Whether the request's validators match the recorded response, as
+        upstream would answer them. If-None-Match takes precedence.
+        """
+        if if_none_match := self.headers.get("If-None-Match"):
+            etag = headers.get("ETag")
+            tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+            return etag is not None and ("*" in tags or etag.removeprefix("W/") in tags)
+
+        if_modified_since = self.headers.get("If-Modified-Since")
+        last_modified = headers.get("Last-Modified")
+        if not (if_modified_since and last_modified):
+            return False
+        try:
+            modified = email.utils.parsedate_to_datetime(last_modified)
+            since = email.utils.parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        return modified <= since
+
+    def _range(self, range_: str, body: bytes, headers: dict):
+        match = RANGE.fullmatch(range_)
+        if match is None or match.groups() == ("", ""):
+            return 200, body
+
+        first, last = match.groups()
+        if first:
+            start = int(first)
+            end = min(int(last), len(body) - 1) if last else len(body) - 1
+        else:
+            start, end = max(0, len(body) - int(last)), len(body) - 1
+        if start > end:
+            headers["Content-Range"] = f"bytes */{len(body)}"
+            return 416, b""
+
+        headers["Content-Range"] = f"bytes {start}-{end}/{len(body)}"
+        return 206, body[start : end + 1]
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run_updater(name: str, stub: StubUpstream, args: list[str], workspace: Path):
+    """
+    Run an update script against the stub, in `workspace`, which holds a copy of
+    `pkgs` and the HTTP cache, kept between runs
+    Returns a dict of its measurements
+    """
+    stats_path = workspace / "stats.json"
+    stats_path.unlink(missing_ok=True)
+
+    env = os.environ | {
+        "NIX_MINECRAFT_UPDATE_UPSTREAM": stub.url,
+        "NIX_MINECRAFT_UPDATE_CACHE": str(workspace / "cache"),
+    }
+    stub.reset()
+    start = time.monotonic()
+    proc = subprocess.Popen(
+        [
+            sys.executable,
+            "-c",
+            BOOTSTRAP,
+            stats_path,
+            workspace / "pkgs" / name / "update.py",
+            *args,
+        ],
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+    )
+    output = proc.stdout.read()
+    # Unlike `Popen.wait`, this also gives the resource usage of the updater,
+    # including any processes it started
+    _, status, rusage = os.wait4(proc.pid, 0)
+    wall = time.monotonic() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+
+    spawns = None
+    if stats_path.exists():
+        spawns = json.loads(stats_path.read_text())["spawns"]
+
+    return {
+        "ok": proc.returncode == 0,
+        "wall": wall,
+        "requests": stub.requests,
+        "misses": sorted(stub.misses),
+        "bytes": stub.bytes,
+        "spawns": spawns,
+        # Linux reports this in KiB
+        "peak_rss": rusage.ru_maxrss * 1024,
+        "output": output.decode(errors="replace"),
+    }
+
+
+def summarize(results: list[dict]):
+    """
+    Combine the measurements of several runs of the same updater, taking the
+    median wall time. The rest should be the same every run.
+    """
+    summary = dict(results[-1])
+    summary["ok"] = all(r["ok"] for r in results)
+    summary["wall"] = statistics.median(r["wall"] for r in results)
+    summary["peak_rss"] = max(r["peak_rss"] for r in results)
+    return summary
+
+
+def git_revision():
+    proc = subprocess.run(
+        ["git", "describe", "--always", "--dirty"],
+        cwd=PKGS,
+        capture_output=True,
+        encoding="UTF-8",
+    )
+    return proc.stdout.strip() or None
+
+
+def run_all(name: str, stub: StubUpstream, runs: int, args: list[str]):
+    """
+    Run an update script `runs` times, the first in a fresh copy of `pkgs` with
+    an empty cache, and the rest after it, in the same copy
+    Returns a list of the measurements of each run
+    """
+    with tempfile.TemporaryDirectory(prefix="nix-minecraft-bench-") as tmp:
+        workspace = Path(tmp)
+        shutil.copytree(
+            PKGS, workspace / "pkgs", ignore=shutil.ignore_patterns("__pycache__")
+        )
+        return [run_updater(name, stub, args, workspace) for _ in range(runs)]
+
+
+def main(names, fixtures, runs=1, args=(), verbose=False):
+    """
+    Benchmark the given updaters, printing a table of the results
+    Returns a dict of {package: measurements}, along with
+    {"package (warm)": measurements} if there was more than one run
+    """
+    stub = StubUpstream(fixtures)
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+
+    results = {}
+    try:
+        for name in names:
+            print(f"Running {name}", file=sys.stderr)
+            measurements = run_all(name, stub, runs, list(args))
+            labels = {name: measurements[:1]}
+            if runs > 1:
+                labels[f"{name} (warm)"] = measurements[1:]
+
+            for label, label_measurements in labels.items():
+                results[label] = result = summarize(label_measurements)
+                if not result["ok"] or verbose:
+                    print(result["output"], file=sys.stderr)
+                if result["misses"]:
+                    print(
+                        f"{label}: {len(result['misses'])} responses not recorded,"
+                        " e.g. " + result["misses"][0],
+                        file=sys.stderr,
+                    )
+    finally:
+        stub.shutdown()
+
+    width = max(map(len, ["package", *results]))
+    print(
+        f"{'package':<{width}}  {'wall':>8}  {'requests':>8}  {'misses':>6}"
+        f"  {'MiB':>8}  {'spawns':>6}  {'peak RSS':>8}  status"
+    )
+    for name, r in results.items():
+        spawns = "?" if r["spawns"] is None else r["spawns"]
+        print(
+            f"{name:<{width}}  {r['wall']:>7.2f}s  {r['requests']:>8}"
+            f"  {len(r['misses']):>6}  {r['bytes'] / 1024 / 1024:>8.2f}"
+            f"  {spawns:>6}  {r['peak_rss'] / 1024 / 1024:>5.0f}MiB"
+            f"  {'ok' if r['ok'] else 'failed'}"
+        )
+
+    return results
+
+
+if __name__ == "__main__":
+    updaters = sorted(path.parent.name for path in PKGS.glob("*/update.py"))
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "packages",
+        nargs="*",
+        metavar="package",
+        help=f"packages to benchmark, out of {', '.join(updaters)} (default: all)",
+    )
+    parser.add_argument(
+        "--fixtures",
+        type=Path,
+        default=FIXTURES,
+        help=f"directory of recorded responses (default: {FIXTURES})",
+    )
+    parser.add_argument(
+        "--record",
+        action="store_true",
+        help="fetch and save responses that weren't recorded yet from upstream",
+    )
+    parser.add_argument(
+        "--runs",
+        type=int,
+        default=1,
+        help="how many times to run each updater; runs after the first reuse its"
+        " locks and cache, and are reported as warm, with their median wall time",
+    )
+    parser.add_argument(
+        "--json",
+        type=Path,
+        metavar="PATH",
+        help="also write the results to PATH, along with the git revision",
+    )
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="print the output of every updater, not just failed ones",
+    )
+    parser.epilog = "Arguments after `--` are passed on to every updater."
+
+    # argparse can't tell the packages apart from the updaters' arguments
+    argv = sys.argv[1:]
+    updater_args = []
+    if "--" in argv:
+        split = argv.index("--")
+        argv, updater_args = argv[:split], argv[split + 1 :]
+    args = parser.parse_args(argv)
+
+    for package in args.packages:
+        if package not in updaters:
+            parser.error(f"no update script for {package}")
+
+    results = main(
+        args.packages or updaters,
+        Fixtures(args.fixtures, args.record),
+        args.runs,
+        updater_args,
+        args.verbose,
+    )
+
+    if args.json:
+        for r in results.values():
+            del r["output"]
+        args.json.write_text(
+            json.dumps({"revision": git_revision(), "results": results}, indent=2)
+            + "\n"
+        )
+
+    sys.exit(0 if all(r["ok"] for r in results.values()) else 1)
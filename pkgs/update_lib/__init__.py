@@ -0,0 +1,6 @@
+"""
+Common functions shared between the `pkgs/*/update.py` scripts.
+
+The update scripts are run directly, so they add `pkgs/` to `sys.path`
+before importing from here.
+"""
@@ -0,0 +1,224 @@
+import asyncio
+import concurrent.futures
+import hashlib
+import io
+import json
+import random
+import threading
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+import urllib3
+from requests.structures import CaseInsensitiveDict
+from requests_cache.policy.expiration import (
+    get_expiration_datetime,
+    get_url_expiration,
+)
+
+from .client import DO_NOT_CACHE, PER_HOST, RETRIES, TIMEOUT, upstream_url
+from .hashing import CHUNK_SIZE, parse_sidecar
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Seconds to wait before the first retry, doubled for every one after it, and
+# jittered so that requests failing together don't retry together
+BACKOFF = 1
+
+
+class Fetcher:
+    """
+    Fetches many URLs concurrently on one event loop, multiplexing requests to
+    the same host over HTTP/2 where the server supports it.
+    Responses are read from and saved to the cache of `client`, a session from
+    `make_client`, according to its expiry patterns, so they are shared with
+    the updaters fetching through it directly.
+    Errors are raised as `requests` exceptions, so they are handled the same
+    either way.
+    """
+
+    def __init__(self, client, per_host=PER_HOST):
+        self.client = client
+        self.per_host = per_host
+        self.limits = {}
+        self.http = None
+        # The loop the fetcher runs on, for `submit`
+        self.loop = None
+
+    async def __aenter__(self):
+        self.http = httpx.AsyncClient(
+            http2=True,
+            timeout=TIMEOUT,
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=None),
+        )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.http.aclose()
+
+    def _limit(self, url: str) -> asyncio.Semaphore:
+        host = urlsplit(url).netloc
+        if host not in self.limits:
+            self.limits[host] = asyncio.Semaphore(self.per_host)
+        return self.limits[host]
+
+    async def _stream(self, url: str, on_chunk):
+        """
+        Stream the body of a successful response to `on_chunk`, retrying
+        failed requests with jittered exponential backoff
+        Returns the response, without its body
+        """
+        for attempt in range(RETRIES + 1):
+            retry = attempt < RETRIES
+            try:
+                async with (
+                    self._limit(url),
+                    self.http.stream("GET", upstream_url(url)) as response,
+                ):
+                    if not (retry and response.status_code in RETRY_STATUSES):
+                        if response.is_error:
+                            raise requests.HTTPError(
+                                f"{response.status_code} Error for url: {url}"
+                            )
+                        async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                            on_chunk(chunk)
+                        return response
+            except httpx.TransportError as e:
+                if not retry:
+                    raise requests.ConnectionError(f"{e!r} for url: {url}") from e
+
+            await asyncio.sleep(random.uniform(0, BACKOFF * 2**attempt))
+
+    def _cache_key(self, url: str) -> str:
+        return self.client.cache.create_key(requests.Request("GET", url).prepare())
+
+    def _save(self, key: str, url: str, response: httpx.Response, content: bytes):
+        expire_after = get_url_expiration(url, self.client.settings.urls_expire_after)
+        if expire_after is None:
+            expire_after = self.client.settings.expire_after
+        if expire_after == DO_NOT_CACHE:
+            return
+
+        # Rebuild the response as requests would have made it. The content is
+        # already decoded, so its encoding mustn't be applied again.
+        headers = {
+            k: v
+            for k, v in response.headers.items()
+            if k.lower() not in ("content-encoding", "content-length")
+        }
+        cached = requests.Response()
+        cached.status_code = response.status_code
+        cached.url = url
+        cached.headers = CaseInsensitiveDict(headers)
+        cached.request = requests.Request("GET", url).prepare()
+        cached.raw = urllib3.HTTPResponse(
+            body=io.BytesIO(content),
+            headers=headers,
+            status=response.status_code,
+            preload_content=False,
+            request_url=url,
+        )
+        self.client.cache.save_response(
+            cached, key, get_expiration_datetime(expire_after)
+        )
+
+    async def get(self, url: str) -> bytes:
+        """
+        Fetch the body of a URL, from the cache if it's there
+        """
+        key = self._cache_key(url)
+        cached = self.client.cache.get_response(key)
+        if cached is not None and not cached.is_expired:
+            return cached.content
+
+        chunks = []
+        response = await self._stream(url, chunks.append)
+        content = b"".join(chunks)
+        self._save(key, url, response, content)
+        return content
+
+    async def hash_url(self, url: str, algorithms=("sha256",)) -> dict:
+        """
+        Hash the body of a URL as it is downloaded, without caching it
+        Returns a dict of {algorithm: hashlib object}
+        """
+        hashes = {alg: hashlib.new(alg) for alg in algorithms}
+
+        def update(chunk):
+            for h in hashes.values():
+                h.update(chunk)
+
+        await self._stream(url, update)
+        return hashes
+
+    async def sidecar_hash(self, url: str, algorithms=("sha256", "sha1")):
+        """
+        Fetch the checksum file that Maven repositories publish next to an
+        artifact (e.g. `foo.jar.sha256`), trying each algorithm in order
+        Returns a tuple of (algorithm, hex digest), or None if none are published
+        """
+        for alg in algorithms:
+            try:
+                content = await self.get(f"{url}.{alg}")
+            except requests.HTTPError:
+                continue
+            if digest := parse_sidecar(alg, content.decode(errors="replace")):
+                return alg, digest
+        return None
+
+    def submit(self, coroutine) -> concurrent.futures.Future:
+        """
+        Run a coroutine using the fetcher on its loop, from synchronous code
+        Returns a future of its result, which cancels it if cancelled
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+
+_fetchers_lock = threading.Lock()
+
+
+def get_fetcher(client) -> Fetcher:
+    """
+    The `Fetcher` of `client`, started on first use on an event loop in its own
+    thread, so that every updater fetching through the client shares its
+    per-host limits
+    """
+    with _fetchers_lock:
+        fetcher = getattr(client, "fetcher", None)
+        if fetcher is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, daemon=True).start()
+            fetcher = Fetcher(client, client.per_host or PER_HOST)
+            fetcher.loop = loop
+            fetcher.submit(fetcher.__aenter__()).result()
+            client.fetcher = fetcher
+    return fetcher
+
+
+def fetch_all(client, urls: list[str], parse=json.loads) -> list:
+    """
+    Fetch all of the URLs concurrently with the client's `Fetcher`, from
+    synchronous code, at most `per_host` at a time to each host as passed to
+    `make_client`
+    Returns the parsed bodies, in the same order as `urls`
+    """
+
+    async def run():
+        tasks = [asyncio.ensure_future(fetcher.get(url)) for url in urls]
+        try:
+            return await asyncio.gather(*tasks)
+        finally:
+            # Don't leave the rest running if one failed or this was cancelled
+            for task in tasks:
+                task.cancel()
+
+    if not urls:
+        return []
+    fetcher = get_fetcher(client)
+    future = fetcher.submit(run())
+    try:
+        contents = future.result()
+    except BaseException:
+        future.cancel()
+        raise
+    return [parse(content) for content in contents]
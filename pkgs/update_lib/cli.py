@@ -0,0 +1,30 @@
+"""
+The command line shared by the update scripts. Each script's `parse_args(argv)`
+adds its own arguments to these, and its `update(args, client)` updates its
+locks with the parsed arguments and a client from `make_client`, which should
+cache according to the script's `CACHE_POLICY`.
+"""
+
+import argparse
+
+from .client import PER_HOST
+
+
+def add_common_args(parser: argparse.ArgumentParser, listings=True):
+    """
+    Add the arguments that every update script takes to `parser`. `--force` is
+    only added if `listings` is set, for scripts that skip runs when their
+    `ListingValidators` report that nothing changed.
+    """
+    parser.add_argument(
+        "--per-host",
+        type=int,
+        default=PER_HOST,
+        help="maximum number of concurrent connections to each upstream",
+    )
+    if listings:
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="run even if upstream reports that nothing changed since the last run",
+        )
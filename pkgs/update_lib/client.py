@@ -0,0 +1,126 @@
+import os
+import re
+from datetime import timedelta
+from pathlib import Path
+from urllib.parse import urlsplit
+
+import requests_cache
+from requests.adapters import HTTPAdapter, Retry
+
+TIMEOUT = 5
+RETRIES = 5
+THREADS = 8
+HOSTS = 32
+# Concurrent connections to any one upstream, across all of the updaters
+# sharing a client. Over HTTP/2, `update_lib.aio` multiplexes these on one.
+PER_HOST = 8
+
+# Expiry policies for the URL classes an updater fetches, used as the values of
+# the `urls_expire_after` patterns passed to `make_client`.
+# Anything that doesn't match a pattern (e.g. version listings) is never cached.
+IMMUTABLE = requests_cache.NEVER_EXPIRE  # content-addressed or published artifacts
+STABLE = timedelta(days=7)  # metadata that should never change, but might be fixed
+DO_NOT_CACHE = requests_cache.DO_NOT_CACHE
+
+# Checksums published next to Maven artifacts, on any repository
+MAVEN_CHECKSUMS = re.compile(r"\.(md5|sha1|sha256|sha512)$")
+
+CACHE_DIR = Path(
+    os.environ.get("NIX_MINECRAFT_UPDATE_CACHE")
+    or Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache")
+    / "nix-minecraft-update"
+)
+MAX_CACHE_SIZE = 512 * 1024 * 1024
+
+# Server to send every request to instead of the real upstreams, as
+# `{UPSTREAM}/{host}/{path}`, like the stub run by `pkgs/update-bench.py`
+UPSTREAM = os.environ.get("NIX_MINECRAFT_UPDATE_UPSTREAM")
+
+
+def upstream_url(url: str) -> str:
+    """
+    The URL to actually request for `url`, which is itself unless `UPSTREAM`
+    is set. Responses are still cached under the original URL.
+    """
+    if not UPSTREAM:
+        return url
+    parts = urlsplit(url)
+    query = f"?{parts.query}" if parts.query else ""
+    return f"{UPSTREAM.rstrip('/')}/{parts.netloc}{parts.path}{query}"
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    def __init__(self, *args, **kwargs):
+        self.timeout = TIMEOUT
+        if "timeout" in kwargs:
+            self.timeout = kwargs["timeout"]
+            del kwargs["timeout"]
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        timeout = kwargs.get("timeout")
+        if timeout is None:
+            kwargs["timeout"] = self.timeout
+        if UPSTREAM:
+            request = request.copy()
+            request.url = upstream_url(request.url)
+        return super().send(request, **kwargs)
+
+
+def make_client(
+    urls_expire_after=None, threads=THREADS, per_host=None
+) -> requests_cache.CachedSession:
+    """
+    Create a session with timeouts and retries, backed by the on-disk cache
+    shared between all of the updaters. `urls_expire_after` maps URL patterns
+    to one of the expiry policies above.
+    If `per_host` is given, requests wait for one of that many connections to
+    each host to be free, instead of opening more. It is also the limit for
+    requests made with `update_lib.aio.fetch_all` through the client.
+    """
+    client = requests_cache.CachedSession(
+        cache_name=str(CACHE_DIR),
+        backend="filesystem",
+        expire_after=DO_NOT_CACHE,
+        urls_expire_after=urls_expire_after,
+        allowable_codes=(200,),
+    )
+    retries = Retry(
+        total=RETRIES, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504]
+    )
+    # Keep a pooled connection around for every worker thread
+    client.mount(
+        "https://",
+        TimeoutHTTPAdapter(
+            max_retries=retries,
+            pool_maxsize=per_host or threads,
+            pool_block=per_host is not None,
+            # Enough to keep a pool for every upstream, so the limits hold
+            pool_connections=HOSTS,
+        ),
+    )
+    client.per_host = per_host
+    return client
+
+
+def prune_cache(client: requests_cache.CachedSession, max_size=MAX_CACHE_SIZE):
+    """
+    Remove expired responses from the cache, then the oldest ones until the
+    cache fits in `max_size` bytes
+    """
+    client.cache.delete(expired=True)
+
+    paths = sorted(client.cache.responses.paths(), key=lambda p: p.stat().st_mtime)
+    size = sum(path.stat().st_size for path in paths)
+    removed = 0
+    for path in paths:
+        if size <= max_size:
+            break
+        size -= path.stat().st_size
+        del client.cache.responses[path.stem]
+        removed += 1
+
+    print(
+        f"HTTP cache: {size / 1024 / 1024:.1f} MiB in {len(paths) - removed} responses"
+        + (f" ({removed} pruned)" if removed else "")
+    )
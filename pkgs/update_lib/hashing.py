@@ -0,0 +1,43 @@
+import base64
+import hashlib
+
+CHUNK_SIZE = 64 * 1024
+
+# Nix's base32 alphabet omits "e", "o", "u" and "t"
+NIX32_ALPHABET = "0123456789abcdfghijklmnpqrsvwxyz"
+
+
+def nix32(digest: bytes) -> str:
+    """
+    Encode a digest in Nix's base32 format, as printed by `nix-prefetch-url`
+    """
+    length = (len(digest) * 8 - 1) // 5 + 1
+    out = []
+    for n in range(length - 1, -1, -1):
+        b = n * 5
+        i, j = divmod(b, 8)
+        c = digest[i] >> j
+        if i + 1 < len(digest):
+            c |= digest[i + 1] << (8 - j)
+        out.append(NIX32_ALPHABET[c & 0x1F])
+    return "".join(out)
+
+
+def sri_hash(alg: str, hex: str) -> str:
+    return f"{alg}-{base64.b64encode(bytes.fromhex(hex)).decode('utf-8')}"
+
+
+def parse_sidecar(alg: str, text: str):
+    """
+    Parse the checksum file that Maven repositories publish next to an artifact
+    (e.g. `foo.jar.sha256`)
+    Returns its hex digest, or None if it isn't a valid `alg` digest
+    """
+    # Some repositories append the file name after the digest
+    digest = text.strip().partition(" ")[0].lower()
+    try:
+        if len(bytes.fromhex(digest)) == hashlib.new(alg).digest_size:
+            return digest
+    except ValueError:
+        pass
+    return None
@@ -0,0 +1,87 @@
+import json
+import threading
+
+from .client import CACHE_DIR
+from .locks import atomic_write_text
+
+VALIDATORS_DIR = CACHE_DIR / "validators"
+
+# Bodies of the listings that changed in this run, by URL, shared between all of
+# the updaters in the process, so that reading them doesn't request them again
+_bodies: dict[str, bytes] = {}
+_bodies_lock = threading.Lock()
+
+
+def get_listing(client, url: str, **kwargs):
+    """
+    Fetch a listing as JSON, reusing its body if `ListingValidators.unchanged`
+    already read it in this run. `kwargs` are passed on to `client.get`.
+    """
+    with _bodies_lock:
+        body = _bodies.get(url)
+    if body is None:
+        response = client.get(url, **kwargs)
+        response.raise_for_status()
+        body = response.content
+    return json.loads(body)
+
+
+class ListingValidators:
+    """
+    The ETag/Last-Modified validators of an updater's upstream listings, as of
+    its last completed run. Sending them back lets upstream tell us that
+    nothing changed, so the run can stop before touching the lock files.
+    """
+
+    def __init__(self, name: str, force: bool = False):
+        self.path = VALIDATORS_DIR / f"{name}.json"
+        self.stored = {}
+        if not force and self.path.exists():
+            self.stored = json.loads(self.path.read_text())
+        self.pending = {}
+
+    def unchanged(self, client, *urls: str) -> bool:
+        """
+        Send conditional requests for the listings, returning whether upstream
+        reported all of them as unchanged since the last completed run.
+        The validators of changed listings are kept until `save` is called, and
+        their bodies for `get_listing`.
+        """
+        unchanged = True
+        for url in urls:
+            headers = {}
+            if etag := self.stored.get(url, {}).get("etag"):
+                headers["If-None-Match"] = etag
+            if last_modified := self.stored.get(url, {}).get("last_modified"):
+                headers["If-Modified-Since"] = last_modified
+
+            response = client.get(url, headers=headers)
+            if response.status_code == 304:
+                continue
+            response.raise_for_status()
+
+            unchanged = False
+            with _bodies_lock:
+                _bodies[url] = response.content
+            self.pending[url] = {
+                k: v
+                for k, v in (
+                    ("etag", response.headers.get("ETag")),
+                    ("last_modified", response.headers.get("Last-Modified")),
+                )
+                if v
+            }
+
+        return unchanged and bool(urls)
+
+    def save(self):
+        """
+        Store the validators of the listings that changed in this run.
+        Should only be called once the lock files have been written, otherwise
+        the next run could skip changes this run didn't lock.
+        """
+        if not self.pending:
+            return
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        atomic_write_text(self.path, json.dumps(self.stored | self.pending, indent=2))
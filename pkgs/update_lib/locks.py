@@ -0,0 +1,139 @@
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+
+# How many changed keys to name in a summary before just counting them
+SUMMARY_NAMES = 5
+
+
+def load_lock(path: Path):
+    """
+    Load a lock file, treating a missing or empty file as an empty lock
+    """
+    if not path.exists() or path.stat().st_size == 0:
+        return {}
+    return json.loads(path.read_text())
+
+
+def atomic_write_text(path: Path, content: str):
+    """
+    Replace the contents of a file, such that a crash at any point leaves
+    either the old or the new contents, never a truncated file.
+    The data is written to a temporary file in the same directory, flushed to
+    disk, and renamed over the original, which keeps its permissions.
+    """
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        if path.exists():
+            os.chmod(tmp_name, path.stat().st_mode & 0o7777)
+        else:
+            # mkstemp creates the file as 0600, use what open() would have
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp_name, 0o666 & ~umask)
+        os.replace(tmp_name, path)
+    except BaseException:
+        Path(tmp_name).unlink(missing_ok=True)
+        raise
+
+    # Make the rename itself durable
+    dir_fd = os.open(path.parent, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+@contextmanager
+def locked(path: Path):
+    """
+    Hold an exclusive lock on a file shared between updaters, so that
+    updaters running in parallel don't overwrite each other's changes.
+    The directory is locked rather than the file, since writing replaces it.
+    """
+    dir_fd = os.open(path.parent, os.O_RDONLY)
+    try:
+        fcntl.flock(dir_fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(dir_fd)
+
+
+def intern(items: list[str], sets: dict[str, list[str]]) -> str:
+    """
+    Add a list to `sets` under an ID derived from its contents, so that lock
+    entries can reference a list shared by many of them instead of repeating it
+    Returns the ID
+    """
+    set_id = hashlib.sha256("\n".join(items).encode()).hexdigest()[:16]
+    sets[set_id] = items
+    return set_id
+
+
+def diff_summary(old, new) -> str:
+    """
+    Summarize the top-level keys added, removed and changed between two locks
+    """
+
+    def names(keys):
+        keys = list(keys)
+        shown = ", ".join(keys[:SUMMARY_NAMES])
+        if len(keys) > SUMMARY_NAMES:
+            shown += f", and {len(keys) - SUMMARY_NAMES} more"
+        return shown
+
+    parts = []
+    for label, keys in (
+        ("added", [k for k in new if k not in old]),
+        ("removed", [k for k in old if k not in new]),
+        ("changed", [k for k in new if k in old and old[k] != new[k]]),
+    ):
+        if keys:
+            parts.append(f"{len(keys)} {label} ({names(keys)})")
+    return "; ".join(parts) or "reformatted"
+
+
+def write_lock(
+    path: Path, data, newline=True, verbose=True, shared=False, base=None, **kwargs
+) -> bool:
+    """
+    Write a lock file, but only if its contents changed, printing a summary of
+    what did unless not `verbose`.
+    If the lock is `shared` with other updaters, it is re-read under a file
+    lock, and only the entries of `data` that differ from `base`, the lock as
+    this updater loaded it, are merged on top of it. That keeps the entries
+    that updaters running in parallel added or changed in the meantime.
+    `kwargs` are passed on to `json.dumps`, along with `indent=2`.
+    The file is replaced atomically, so it is never left half-written.
+    Returns whether the file was written.
+    """
+    if shared:
+        base = base or {}
+        changes = {k: v for k, v in data.items() if k not in base or base[k] != v}
+        with locked(path):
+            return write_lock(
+                path, load_lock(path) | changes, newline, verbose, **kwargs
+            )
+
+    content = json.dumps(data, indent=2, **kwargs) + ("\n" if newline else "")
+
+    old_content = path.read_text() if path.exists() else ""
+    if content == old_content:
+        if verbose:
+            print(f"{path.name}: unchanged")
+        return False
+
+    if verbose:
+        old = json.loads(old_content) if old_content.strip() else {}
+        print(f"{path.name}: {diff_summary(old, json.loads(content))}")
+
+    atomic_write_text(path, content)
+    return True
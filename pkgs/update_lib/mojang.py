@@ -0,0 +1,75 @@
+import concurrent.futures
+import threading
+
+from .aio import fetch_all
+from .client import IMMUTABLE
+from .listings import get_listing
+
+MANIFEST = "https://launchermeta.mojang.com/mc/game/version_manifest_v2.json"
+
+# Version JSONs are content-addressed, so they never change.
+# Updaters reading them should include these in their `CACHE_POLICY`.
+VERSION_JSONS = {
+    "piston-meta.mojang.com/v1/packages/": IMMUTABLE,
+    "launchermeta.mojang.com/v1/packages/": IMMUTABLE,
+}
+
+# Documents fetched so far in this run, by URL, shared between all of the
+# updaters in the process. Failed fetches are forgotten, so they can be retried.
+_documents: dict[str, concurrent.futures.Future] = {}
+_documents_lock = threading.Lock()
+
+
+def _get_json(client, url: str):
+    with _documents_lock:
+        future = _documents.get(url)
+        fetching = future is None
+        if fetching:
+            future = _documents[url] = concurrent.futures.Future()
+
+    # Anyone else asking for the same URL in the meantime waits on the future
+    if fetching:
+        try:
+            future.set_result(get_listing(client, url))
+        except BaseException as e:
+            with _documents_lock:
+                del _documents[url]
+            future.set_exception(e)
+
+    return future.result()
+
+
+def get_manifest(client) -> dict[str, dict]:
+    """
+    Fetch Mojang's version manifest, at most once per run
+    Returns a dict of {id: entry}, where each entry has the version's "url",
+    "sha1" and "type", among others. It is shared, so must not be modified.
+    """
+    return {v["id"]: v for v in _get_json(client, MANIFEST)["versions"]}
+
+
+def get_version_jsons(client, urls: list[str]) -> list[dict]:
+    """
+    Fetch version JSONs from the manifest concurrently, at most once per run,
+    and only once ever if the client caches `VERSION_JSONS`.
+    Returns them in the same order as `urls`. They are shared, so must not be
+    modified.
+    """
+    with _documents_lock:
+        futures = {url: _documents.get(url) for url in urls}
+        missing = [url for url, future in futures.items() if future is None]
+        for url in missing:
+            futures[url] = _documents[url] = concurrent.futures.Future()
+
+    try:
+        for url, data in zip(missing, fetch_all(client, missing)):
+            futures[url].set_result(data)
+    except BaseException as e:
+        with _documents_lock:
+            for url in missing:
+                del _documents[url]
+        for url in missing:
+            futures[url].set_exception(e)
+        raise
+
+    return [futures[url].result() for url in urls]
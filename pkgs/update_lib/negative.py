@@ -0,0 +1,48 @@
+from datetime import date, timedelta
+from pathlib import Path
+
+from .locks import load_lock, write_lock
+
+# How long to trust a negative result before trying it again
+DEFAULT_TTL = timedelta(days=30)
+
+
+class NegativeCache:
+    """
+    Things an updater looked up and found nothing to lock for, like versions
+    without a server or failed builds, along with the date they were recorded.
+    Later runs skip them, until they are older than `ttl` and are retried, in
+    case upstream has fixed them since.
+    Stored next to the lock, as {key: ISO date}, so it persists between runs.
+    """
+
+    def __init__(self, path: Path, ttl: timedelta = DEFAULT_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.today = date.today()
+        self.entries: dict[str, str] = load_lock(path)
+
+    def __contains__(self, key: str) -> bool:
+        """
+        Whether `key` has a negative result that hasn't expired yet
+        """
+        recorded = self.entries.get(key)
+        if recorded is None:
+            return False
+        return self.today - date.fromisoformat(recorded) < self.ttl
+
+    def add(self, key: str):
+        """
+        Record a negative result for `key`, restarting its expiry if it was
+        already recorded
+        """
+        self.entries[key] = self.today.isoformat()
+
+    def discard(self, key: str):
+        """
+        Forget the result for `key`, once something was found for it after all
+        """
+        self.entries.pop(key, None)
+
+    def save(self, verbose=True) -> bool:
+        return write_lock(self.path, self.entries, verbose=verbose, sort_keys=True)
@@ -0,0 +1,148 @@
+import io
+import json
+import re
+import struct
+import zipfile
+import zlib
+
+# Smallest range to request at once. The first request fetches this much of the
+# end of the file, which usually covers the whole central directory of a zip.
+BLOCK_SIZE = 64 * 1024
+
+CONTENT_RANGE = re.compile(r"bytes (\d+)-(\d+)/(\d+)")
+
+
+class RangesNotSupported(Exception):
+    pass
+
+
+class RangeFile(io.RawIOBase):
+    """
+    A read-only, seekable file over HTTP, which only fetches the parts that are
+    actually read, using Range requests.
+    Raises `RangesNotSupported` if the server ignores the Range header.
+    """
+
+    def __init__(self, client, url: str, block_size=BLOCK_SIZE):
+        super().__init__()
+        self.client = client
+        self.url = url
+        self.block_size = block_size
+        self.position = 0
+        self.fetched = 0
+        # (start, data) of every range fetched so far
+        self.spans: list[tuple[int, bytes]] = []
+
+        self.size = None
+        self._fetch(f"-{block_size}")
+
+    def _fetch(self, range_spec: str):
+        with self.client.get(
+            self.url, headers={"Range": f"bytes={range_spec}"}, stream=True
+        ) as response:
+            response.raise_for_status()
+            if response.status_code != 206:
+                raise RangesNotSupported(f"{self.url} does not support ranges")
+            match = CONTENT_RANGE.fullmatch(response.headers.get("Content-Range", ""))
+            if match is None:
+                raise RangesNotSupported(f"{self.url} sent an invalid Content-Range")
+            data = response.content
+
+        start, _, size = map(int, match.groups())
+        self.size = size
+        self.fetched += len(data)
+        self.spans.append((start, data))
+
+    def _cached(self, position: int):
+        for start, data in self.spans:
+            if start <= position < start + len(data):
+                return memoryview(data)[position - start :]
+        return None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.size + offset
+        else:
+            raise ValueError(f"invalid whence ({whence})")
+        return self.position
+
+    def readinto(self, b):
+        # Always fill the buffer, as zipfile doesn't expect short reads
+        wanted = max(0, min(len(b), self.size - self.position))
+        done = 0
+        while done < wanted:
+            position = self.position + done
+            chunk = self._cached(position)
+            if chunk is None:
+                end = min(position + max(wanted - done, self.block_size), self.size)
+                self._fetch(f"{position}-{end - 1}")
+                continue
+            n = min(len(chunk), wanted - done)
+            b[done : done + n] = chunk[:n]
+            done += n
+
+        self.position += wanted
+        return wanted
+
+
+def open_remote_zip(client, url: str) -> zipfile.ZipFile:
+    """
+    Open a zip file over HTTP, fetching only the central directory and the
+    entries that are read, rather than the whole archive.
+    Raises `RangesNotSupported` if the server can't serve parts of the file.
+    """
+    return zipfile.ZipFile(RangeFile(client, url))
+
+
+def read_raw_entry(zf: zipfile.ZipFile, name: str) -> tuple[int, int, bytes]:
+    """
+    Read an entry of a zip without decompressing it, so that can be done
+    elsewhere, e.g. in a process pool
+    Returns its compression method, CRC and compressed data
+    """
+    info = zf.getinfo(name)
+    zf.fp.seek(info.header_offset)
+    header = zf.fp.read(zipfile.sizeFileHeader)
+    # The local header's extra field can differ from the central directory's
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    zf.fp.seek(name_length + extra_length, io.SEEK_CUR)
+    return info.compress_type, info.CRC, zf.fp.read(info.compress_size)
+
+
+def decompress_raw_entry(compress_type: int, crc: int, data: bytes) -> bytes:
+    if compress_type == zipfile.ZIP_STORED:
+        content = data
+    elif compress_type == zipfile.ZIP_DEFLATED:
+        content = zlib.decompress(data, -zlib.MAX_WBITS)
+    else:
+        raise zipfile.BadZipFile(f"Unsupported compression method {compress_type}")
+
+    if zlib.crc32(content) != crc:
+        raise zipfile.BadZipFile("Bad CRC-32 for raw entry")
+    return content
+
+
+def load_json_entries(source, names: list[str]) -> list:
+    """
+    Parse JSON entries of a zip, given either the path to it, or a dict of the
+    entries read by `read_raw_entry`. Doesn't touch the network, so it can be
+    run in a process pool.
+    """
+    if isinstance(source, dict):
+        return [json.loads(decompress_raw_entry(*source[name])) for name in names]
+
+    with zipfile.ZipFile(source, "r") as zf:
+        return [json.loads(zf.read(name)) for name in names]
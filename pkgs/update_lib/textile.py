@@ -0,0 +1,384 @@
+# The parts of the Fabric, Quilt and Legacy Fabric updaters that don't depend on
+# the loader. Each of their update scripts is a module providing:
+# - `ENDPOINT`, the versions endpoint of the loader's meta API
+# - `get_loader_versions(client)` and `get_game_versions(client)`, the filtered
+#   lists of versions to package
+# - `fetch_loader_versions(client, loader_versions)`, a dict of
+#   {loader version: {"mainClass": string, "libraries": [...]}}
+# - `get_mappings(client)`, the mappings of every game version, and
+#   `game_version_libraries(mappings, game_version)`, which looks up the
+#   libraries of a game version in them, as {"libraries": [...]}
+
+import argparse
+import asyncio
+import concurrent.futures
+import copy
+import logging
+import subprocess
+from pathlib import Path
+
+import requests
+
+from .aio import get_fetcher
+from .cli import add_common_args
+from .hashing import nix32, sri_hash
+from .listings import ListingValidators
+from .locks import intern, load_lock, write_lock
+
+logger = logging.getLogger()
+
+THREADS = 8
+
+
+async def prefetch_library(
+    fetcher, logger, name, url, add_to_store=False, use_sidecars=True
+):
+    """
+    Prefetch a single library with a `Fetcher`, returning its entry in the
+    library lock
+    If `use_sidecars` is set, the checksum published by the Maven repository is
+    used, falling back to hashing the jar as it is streamed. If `add_to_store`
+    is set, `nix-prefetch-url` is used instead, to also add it to the Nix store
+    """
+    logger.info(f"Fetching {name}")
+    ldir, lname, lversion = name.split(":")
+    lfilename = f"{lname}-{lversion}.jar"
+    lurl = "/".join(
+        (
+            url.rstrip("/"),
+            ldir.replace(".", "/"),
+            lname,
+            lversion,
+            f"{lname}-{lversion}.jar",
+        )
+    )
+
+    if add_to_store:
+        proc = await asyncio.create_subprocess_exec(
+            "nix-prefetch-url",
+            lurl,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        stdout, _ = await proc.communicate()
+        lhash = stdout.decode("UTF-8").rstrip("\n")
+        return {"name": lfilename, "url": lurl, "sha256": lhash}
+
+    try:
+        if use_sidecars and (sidecar := await fetcher.sidecar_hash(lurl)):
+            alg, digest = sidecar
+            logger.debug(f"Using published {alg} for {name}")
+            if alg == "sha256":
+                return {
+                    "name": lfilename,
+                    "url": lurl,
+                    "sha256": nix32(bytes.fromhex(digest)),
+                }
+            return {"name": lfilename, "url": lurl, "hash": sri_hash(alg, digest)}
+
+        lhash = nix32((await fetcher.hash_url(lurl))["sha256"].digest())
+    except requests.RequestException as e:
+        # Left empty so that it gets fetched again on the next run
+        logger.warning(f"Failed to fetch {name}: {e}")
+        lhash = ""
+
+    return {"name": lfilename, "url": lurl, "sha256": lhash}
+
+
+def is_fetched(library):
+    """
+    Whether a library lock entry is complete, rather than left empty by a
+    failed fetch
+    """
+    return all(library.values())
+
+
+def is_locked(lock, libraries, library_sets):
+    """
+    Whether a version is locked, with all of its libraries fetched. Versions
+    whose libraries failed are locked again, which retries them.
+    """
+    if not lock:
+        return False
+    names = library_sets.get(lock.get("librarySet"), []) + lock["libraries"]
+    return all(name in libraries and is_fetched(libraries[name]) for name in names)
+
+
+class LibraryPrefetcher:
+    """
+    Prefetches libraries concurrently on the client's `Fetcher`, so that their
+    many small checksum requests share its connections and per-host limits.
+    At most `threads` run `nix-prefetch-url` at once with `add_to_store`.
+    Libraries that are already in flight are not submitted again, and results
+    are added to `libraries` in the order they were first requested, so the
+    lock is identical to a serial run.
+    """
+
+    def __init__(
+        self,
+        logger,
+        libraries,
+        client,
+        threads=THREADS,
+        add_to_store=False,
+        use_sidecars=True,
+    ):
+        self.logger = logger.getChild("libraries")
+        self.libraries = libraries
+        self.fetcher = get_fetcher(client)
+        self.add_to_store = add_to_store
+        self.use_sidecars = use_sidecars
+        self.store_limit = asyncio.Semaphore(threads)
+        self.in_flight = {}
+        # Libraries that failed to fetch for the first time
+        self.failed = set()
+
+    def prefetch(self, version_libraries):
+        """
+        Schedule any missing libraries for prefetching, returning the names of
+        all the given libraries
+        """
+        ret = []
+
+        for library in version_libraries:
+            name, url = library["name"], library["url"]
+
+            if name in self.in_flight:
+                self.logger.debug(f"Already fetching {name}")
+            elif name not in self.libraries or not is_fetched(self.libraries[name]):
+                self.in_flight[name] = self.fetcher.submit(self._prefetch(name, url))
+            else:
+                self.logger.debug(f"Using cached {name}")
+
+            ret.append(name)
+
+        return ret
+
+    async def _prefetch(self, name, url):
+        if not self.add_to_store:
+            return await prefetch_library(
+                self.fetcher, self.logger, name, url, use_sidecars=self.use_sidecars
+            )
+        async with self.store_limit:
+            return await prefetch_library(
+                self.fetcher, self.logger, name, url, add_to_store=True
+            )
+
+    def finish(self, cancel=False):
+        """
+        Wait for all scheduled libraries and add them to `libraries`.
+        If `cancel` is set, libraries that haven't been fetched yet are dropped.
+        Returns the names of the libraries that were not fetched.
+        """
+        if cancel:
+            for future in self.in_flight.values():
+                future.cancel()
+        concurrent.futures.wait(self.in_flight.values())
+
+        missing = set()
+        for name, future in self.in_flight.items():
+            if future.cancelled():
+                missing.add(name)
+            else:
+                library = future.result()
+                if not is_fetched(library) and name not in self.libraries:
+                    self.failed.add(name)
+                self.libraries[name] = library
+
+        self.in_flight = {}
+        return missing
+
+
+def gen_loader_locks(loader_version, version, prefetcher, library_sets):
+    """
+    Return the lock information for a given loader version, returned in the format
+    {
+        "mainClass": string,
+        "librarySet": string,
+        "libraries": [string, ...]
+    }
+    The loader's own library is kept in "libraries", while the ones it shares
+    with other loader versions are added to `library_sets` under "librarySet".
+    Together they are in the original order, with the loader's own at the end.
+    """
+    libraries = prefetcher.prefetch(version["libraries"])
+    own = [library for library in libraries if library.endswith(f":{loader_version}")]
+    shared = [library for library in libraries if library not in own]
+
+    ret = {
+        "mainClass": version["mainClass"],
+        "librarySet": intern(shared, library_sets),
+        "libraries": own,
+    }
+
+    return ret
+
+
+def gen_game_locks(version, prefetcher):
+    """
+    Return the lock information for a given loader version, returned in the format
+    {
+        "libraries": [
+            {"name": string, "url": string, "sha256": string},
+            ...
+        ]
+    }
+    """
+    return {"libraries": prefetcher.prefetch(version["libraries"])}
+
+
+def main(
+    upstream,
+    versions_loader,
+    versions_game,
+    libraries,
+    library_sets,
+    client,
+    threads=THREADS,
+    add_to_store=False,
+    use_sidecars=True,
+):
+    """
+    Fetch the relevant information from `upstream`, the loader's update script,
+    and update the locks.
+    `versions`, `libraries` and `library_sets` are data from the existing files,
+    which are updated in place
+    Returns whether every version was fetched, and no library failed to fetch
+    for the first time, so that the next run retries it even if the listings
+    haven't changed
+    """
+    loader_versions = upstream.get_loader_versions(client)
+    game_versions = upstream.get_game_versions(client)
+
+    prefetcher = LibraryPrefetcher(
+        logger, libraries, client, threads, add_to_store, use_sidecars
+    )
+
+    logger.info("Starting fetch")
+    completed = True
+    try:
+        logger.info("Fetching loader versions")
+        loader_logger = logger.getChild("loader")
+        fetched = upstream.fetch_loader_versions(
+            client,
+            [
+                v
+                for v in loader_versions
+                if not is_locked(versions_loader.get(v), libraries, library_sets)
+            ],
+        )
+        for loader_version in loader_versions:
+            if loader_version in fetched:
+                loader_logger.info(f"Locking version: {loader_version}")
+                versions_loader[loader_version] = gen_loader_locks(
+                    loader_version,
+                    fetched[loader_version],
+                    prefetcher,
+                    library_sets,
+                )
+            else:
+                loader_logger.info(f"Version {loader_version} already locked")
+
+        logger.info("Fetching game versions")
+        game_logger = logger.getChild("game")
+        mappings = None
+        for game_version in game_versions:
+            if not is_locked(versions_game.get(game_version), libraries, library_sets):
+                game_logger.info(f"Fetching version: {game_version}")
+                if mappings is None:
+                    mappings = upstream.get_mappings(client)
+                versions_game[game_version] = gen_game_locks(
+                    upstream.game_version_libraries(mappings, game_version),
+                    prefetcher,
+                )
+            else:
+                game_logger.info(f"Version {game_version} already locked")
+
+        logger.info("Waiting for library prefetches")
+        prefetcher.finish()
+        completed = not prefetcher.failed
+
+    except KeyboardInterrupt:
+        logger.warning("Cancelled fetching, writing and exiting")
+        completed = False
+        missing = prefetcher.finish(cancel=True)
+        # Drop versions that depend on libraries that were never fetched
+        for locks in (versions_loader, versions_game):
+            for version, lock in list(locks.items()):
+                shared = library_sets.get(lock.get("librarySet"), [])
+                if not missing.isdisjoint(shared + lock["libraries"]):
+                    del locks[version]
+
+    return completed
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser()
+    add_common_args(parser)
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=THREADS,
+        help="maximum number of libraries to prefetch concurrently with --add-to-store",
+    )
+    parser.add_argument(
+        "--add-to-store",
+        action="store_true",
+        help="prefetch libraries with nix-prefetch-url, adding them to the Nix store",
+    )
+    parser.add_argument(
+        "--no-sidecars",
+        dest="use_sidecars",
+        action="store_false",
+        help="always download libraries to hash them, ignoring published checksums",
+    )
+    return parser.parse_args(argv)
+
+
+def update(args, client, upstream):
+    """
+    Update the locks of `upstream`, the loader's update script, along with the
+    libraries shared with the other loaders
+    """
+    folder = Path(upstream.__file__).parent
+    llo = folder / "loader_locks.json"
+    glo = folder / "game_locks.json"
+    lso = folder / "library_sets.json"
+
+    build_support_folder = folder.parent / "build-support"
+    li = build_support_folder / "libraries.json"
+
+    versions_loader = load_lock(llo)
+    versions_game = load_lock(glo)
+    libraries = load_lock(li)
+    # As loaded, so only this run's changes are merged into the shared lock
+    libraries_base = copy.deepcopy(libraries)
+    library_sets = load_lock(lso)
+
+    listings = ListingValidators(folder.name, args.force)
+    if listings.unchanged(
+        client, f"{upstream.ENDPOINT}/game", f"{upstream.ENDPOINT}/loader"
+    ):
+        logger.info("Versions unchanged since the last run, nothing to do")
+        return
+
+    completed = main(
+        upstream,
+        versions_loader,
+        versions_game,
+        libraries,
+        library_sets,
+        client,
+        args.threads,
+        args.add_to_store,
+        args.use_sidecars,
+    )
+    # Libraries first, so the version locks never reference missing ones.
+    # libraries.json is shared with the other textile updaters, which may be
+    # running in parallel.
+    write_lock(li, libraries, shared=True, base=libraries_base)
+    write_lock(lso, library_sets)
+    write_lock(glo, versions_game)
+    write_lock(llo, versions_loader)
+    if completed:
+        listings.save()
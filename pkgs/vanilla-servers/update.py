@@ -1,64 +1,57 @@
 #!/usr/bin/env nix-shell
-#!nix-shell -i python3 -p python3Packages.requests
+#!nix-shell -i python3 -p python3Packages.h2 python3Packages.httpx python3Packages.requests python3Packages.requests-cache
 
-import json
-import requests
+import argparse
+import sys
+from datetime import timedelta
 from pathlib import Path
-from typing import Union, Dict
+from typing import Union, Dict, Tuple
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from update_lib.cli import add_common_args
+from update_lib.client import make_client, prune_cache
+from update_lib.listings import ListingValidators
+from update_lib.locks import load_lock, write_lock
+from update_lib.mojang import MANIFEST, VERSION_JSONS, get_manifest, get_version_jsons
+from update_lib.negative import DEFAULT_TTL, NegativeCache
 
-# These versions don't have servers
-BLACKLIST = [
-    "1.2.4",
-    "1.2.3",
-    "1.2.2",
-    "1.2.1",
-    "1.1",
-    "1.0",
-]
+CACHE_POLICY = VERSION_JSONS
 
 
-def parse_manifest() -> Dict[str, str]:
+def parse_manifest(client) -> Dict[str, Tuple[str, str]]:
     """
     Fetches the version manifest from Mojang and processes it
-    Returns its output as a dict of {id: url}
+    Returns its output as a dict of {id: (url, sha1)}, where sha1 is the hash
+    of the version JSON at url
     """
 
     print("Fetching manifest")
-    response = requests.get(
-        "https://launchermeta.mojang.com/mc/game/version_manifest.json"
-    )
-    response.raise_for_status()
 
     return dict(
         map(
-            lambda elem: (elem["id"], elem["url"]),
+            lambda elem: (elem["id"], (elem["url"], elem["sha1"])),
             filter(
                 lambda elem: elem["type"] in ("release", "snapshot"),
-                response.json()["versions"],
+                get_manifest(client).values(),
             ),
         )
     )
 
 
-def parse_version(url) -> Union[Dict[str, Union[str, int]], None]:
+def parse_version(url, sha1, data) -> Union[Dict[str, Union[str, int]], None]:
     """
-    Fetches the version JSON at the URl and processes it
+    Processes the version JSON fetched from the URL, with the given sha1
     Returns a dict in the form:
     {
         "url": string,
         "sha1": string,
         "version": string,
         "javaVersion": int,
-        "manifestUrl": string
+        "manifestUrl": string,
+        "manifestSha1": string
     }
     """
 
-    print(f"Fetching {url}")
-    response = requests.get(url)
-    response.raise_for_status()
-
-    data = response.json()
     if "server" in data["downloads"]:
         return {
             "url": data["downloads"]["server"]["url"],
@@ -66,44 +59,92 @@ def parse_version(url) -> Union[Dict[str, Union[str, int]], None]:
             "version": data["id"],
             "javaVersion": data.get("javaVersion", {"majorVersion": 8})["majorVersion"],
             "manifestUrl": url,
+            "manifestSha1": sha1,
         }
 
 
-def main(versions, lock_file):
+def main(versions, no_server, client):
     """
-    Takes in a dict of the existing version lock, and the output file
-    Fetches the version manifest and fetches any missing/changed versions
-    Writes the new version lock to the output file
+    Takes in a dict of the existing version lock, and a `NegativeCache` of the
+    versions known not to have a server
+    Fetches the version manifest and fetches any missing/changed versions,
+    updating both in place
+    Returns whether every version was fetched
     """
 
-    manifest = parse_manifest()
+    manifest = parse_manifest(client)
+
+    # {id: sha1} of the version JSONs that were locked, so that the versions
+    # which are new or were republished can be found in one pass
+    locked = {version: v.get("manifestSha1") for version, v in versions.items()}
+
+    to_fetch = [
+        (version, url, sha1)
+        for version, (url, sha1) in manifest.items()
+        if version not in no_server and locked.get(version) != sha1
+    ]
 
+    print(f"Fetching {len(to_fetch)} versions...")
+
+    completed = True
     try:
-        for version, url in manifest.items():
-            if (
-                not (v := versions.get(version, None))
-                or v.get("manifestUrl", None) != url
-            ):  # Fetch if version isn't locked or if manifest url changes
-                if version in BLACKLIST:
-                    continue
-                elif (parsed := parse_version(url)) is not None:
-                    versions[version] = parsed
-                else:
-                    print(f"{version} has no server, add to blacklist")
+        # Results are returned in manifest order, regardless of completion order,
+        # so the lock is identical to a serial run
+        datas = get_version_jsons(client, [url for _, url, _ in to_fetch])
+        for (version, url, sha1), data in zip(to_fetch, datas):
+            parsed = parse_version(url, sha1, data)
+            if parsed is not None:
+                versions[version] = parsed
+                no_server.discard(version)
+            else:
+                print(
+                    f"{version} has no server, skipping it for {no_server.ttl.days} days"
+                )
+                no_server.add(version)
     except KeyboardInterrupt:
         print("Cancelled fetching. Writing and exiting")
+        completed = False
 
-    json.dump(versions, lock_file, indent=2)
-    lock_file.write("\n")
+    return completed
 
 
-if __name__ == "__main__":
-    lock_path = Path(__file__).parent / "versions.json"
-    lock_path.touch()
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser()
+    add_common_args(parser)
+    parser.add_argument(
+        "--retry-after",
+        type=int,
+        default=DEFAULT_TTL.days,
+        help="days after which to check versions without a server again",
+    )
+    return parser.parse_args(argv)
 
-    versions = (
-        {} if lock_path.stat().st_size == 0 else json.loads(lock_path.read_text())
+
+def update(args, client):
+    """
+    Update the version lock, and the versions known to have no server
+    """
+    lock_path = Path(__file__).parent / "versions.json"
+    versions = load_lock(lock_path)
+    # Versions found to have no server
+    no_server = NegativeCache(
+        Path(__file__).parent / "bad.json", timedelta(days=args.retry_after)
     )
 
-    with lock_path.open("w") as lock_file:
-        main(versions, lock_file)
+    listings = ListingValidators(Path(__file__).parent.name, args.force)
+    if listings.unchanged(client, MANIFEST):
+        print("Manifest unchanged since the last run, nothing to do")
+        return
+
+    completed = main(versions, no_server, client)
+    write_lock(lock_path, versions)
+    no_server.save()
+    if completed:
+        listings.save()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    client = make_client(CACHE_POLICY, per_host=args.per_host)
+    update(args, client)
+    prune_cache(client)
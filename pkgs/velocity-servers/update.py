@@ -1,61 +1,49 @@
 #!/usr/bin/env nix-shell
-#!nix-shell -i python3 -p python3Packages.requests
+#!nix-shell -i python3 -p python3Packages.h2 python3Packages.httpx python3Packages.requests python3Packages.requests-cache
 
-import json
+import argparse
+import sys
 from pathlib import Path
 
-import requests
-from requests.adapters import HTTPAdapter, Retry
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from update_lib.aio import fetch_all
+from update_lib.cli import add_common_args
+from update_lib.client import make_client, prune_cache
+from update_lib.listings import ListingValidators, get_listing
+from update_lib.locks import write_lock
 
 ENDPOINT = "https://fill.papermc.io/v3/projects/velocity"
 
-TIMEOUT = 5
-RETRIES = 5
-
-
-class TimeoutHTTPAdapter(HTTPAdapter):
-    def __init__(self, *args, **kwargs):
-        self.timeout = TIMEOUT
-        if "timeout" in kwargs:
-            self.timeout = kwargs["timeout"]
-            del kwargs["timeout"]
-        super().__init__(*args, **kwargs)
-
-    def send(self, request, **kwargs):
-        timeout = kwargs.get("timeout")
-        if timeout is None:
-            kwargs["timeout"] = self.timeout
-        return super().send(request, **kwargs)
-
-
-def make_client():
-    http = requests.Session()
-    retries = Retry(
-        total=RETRIES, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504]
-    )
-    http.mount("https://", TimeoutHTTPAdapter(max_retries=retries))
-    return http
+# Build listings are always fetched fresh, so nothing is cached
+CACHE_POLICY = {}
 
 
 def get_versions(client):
     print("Fetching versions")
-    data = client.get(f"{ENDPOINT}/versions").json()
+    data = get_listing(client, f"{ENDPOINT}/versions")
     return sorted([v["version"]["id"] for v in data["versions"]])
 
 
-def get_builds(version, client):
-    print(f"Fetching builds for {version}")
-    data = client.get(f"{ENDPOINT}/versions/{version}/builds").json()
-    return sorted(data, key=lambda build: build["id"])
+def get_all_builds(versions, client):
+    """
+    Fetch the builds of each version concurrently
+    Returns a dict of {version: builds}, in the same order as `versions`
+    """
+    print(f"Fetching builds for {len(versions)} versions")
+    urls = [f"{ENDPOINT}/versions/{version}/builds" for version in versions]
+    return {
+        version: sorted(data, key=lambda build: build["id"])
+        for version, data in zip(versions, fetch_all(client, urls))
+    }
 
 
-def main(lock, client):
+def main(client):
     output = {}
     print("Starting fetch")
 
-    for version in get_versions(client):
+    for version, builds in get_all_builds(get_versions(client), client).items():
         output[version] = {}
-        for build in get_builds(version, client):
+        for build in builds:
             build_number = build["id"]
             build_channel = build["channel"]
             build_sha256 = build["downloads"]["server:default"]["checksums"]["sha256"]
@@ -66,11 +54,32 @@ def main(lock, client):
                 "channel": build_channel,
             }
 
-    json.dump(output, lock, indent=2)
-    lock.write("\n")
+    return output
 
 
-if __name__ == "__main__":
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser()
+    add_common_args(parser)
+    return parser.parse_args(argv)
+
+
+def update(args, client):
+    """
+    Update the build lock, which is always generated from scratch
+    """
     folder = Path(__file__).parent
     lock_path = folder / "lock.json"
-    main(open(lock_path, "w"), make_client())
+    listings = ListingValidators(folder.name, args.force)
+    if listings.unchanged(client, f"{ENDPOINT}/versions"):
+        print("Versions unchanged since the last run, nothing to do")
+        return
+
+    write_lock(lock_path, main(client))
+    listings.save()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    client = make_client(CACHE_POLICY, per_host=args.per_host)
+    update(args, client)
+    prune_cache(client)